@@ -1,33 +1,39 @@
 """Experiment Manager: A tool for managing deep learning experiments."""
 import argparse
-import datetime
+import functools
 import os
 from os import path as osp
-import shelve
 import shutil
 import sys
 
-import pygit2
+from em import compare
+from em import db
+from em import jobs
+from em import report
+from em import sched
+from em import sources
+from em import util
 
 
-GIT_UNCH = {pygit2.GIT_STATUS_CURRENT, pygit2.GIT_STATUS_IGNORED}
-
-EM_KEY = '__em__'
-
 E_BRANCH_EXISTS = 'error: branch "{}" already exists'
 E_CHECKED_OUT = 'error: cannot run experiment on checked out branch'
+E_EMPTY_SWEEP = 'error: sweep has no --grid or --list arguments'
 E_CANT_CLEAN = 'error: could not clean up {}'
+E_CTL_FAILED = 'error: experiment "{}" failed the command: {}'
+E_CTL_TIMEOUT = 'error: experiment "{}" did not answer the command in time'
 E_IS_NOT_RUNNING = 'error: experiment "{}" is not running'
 E_IS_RUNNING = 'error: experiment "{}" is already running'
 E_MODIFIED_SRC = 'error: not updating existing branch with source changes'
 E_MOVE_DIR = 'error: could not move experiment directory'
 E_NAME_EXISTS = 'error: experiment named "{}" already exists'
-E_NO_BRANCH = 'error: no branch for experiment "{}"?'
-E_NO_EXP = 'error: no experiment named "{}"'
 E_NO_PROJ = 'error: "{}" is not a project directory'
+E_NO_SLOTS = 'error: no resource slots configured (use --slots)'
 E_OTHER_MACHINE = 'error: experiment "{}" is not running on this machine'
 E_RENAME_BRANCH = 'error: could not rename branch'
 E_RENAME_RUNNING = 'error: cannot rename running experiment'
+E_NO_SUPERVISOR = 'error: no supervisor is running'
+E_STALE = 'error: experiment "{}" is not responding (try `em reap`)'
+E_SUPERVISOR_RUNNING = 'error: a supervisor is already running'
 
 RUN_RECREATE_PROMPT = 'Experiment {} already exists. Recreate? [yN] '
 
@@ -40,29 +46,25 @@ CLEAN_SNAPS_PROMPT = 'Clean up snaps of {:d} experiments? [yN] '
 LI_RUNNING = LI + ' (running)'
 RESET_PREAMBLE = 'The following experiments will be reset:'
 RESET_PROMPT = 'Reset {:d} experiments? [yN] '
+REAP_PREAMBLE = 'The following experiments are no longer running:'
+SUPERVISOR_STOPPING = 'Supervisor will stop after {:d} running jobs exit.'
 
-
-def _die(msg, status=1):
-    print(msg, file=sys.stderr)
-    return status
+# max number of experiments `em ctl` sends a command to at once
+CTL_WORKERS = 16
 
 
 def _ensure_proj(cb):
     def _docmd(*args, **kwargs):
-        with shelve.open('.em') as emdb:
-            if EM_KEY not in emdb:
-                curdir = osp.abspath('.')
-                return _die(E_NO_PROJ.format(curdir))
-        cb(*args, **kwargs)
+        if not db.is_project():
+            curdir = osp.abspath('.')
+            return util.die(E_NO_PROJ.format(curdir))
+        return cb(*args, **kwargs)
     return _docmd
 
 
-def _expath(*args):
-    return osp.abspath(osp.join('experiments', *args))
-
-
 def proj_create(args, config, _extra_args):
     """Creates a new em-managed project."""
+    import pygit2
     tmpl_repo = config['project']['template_repo']
     try:
         pygit2.clone_repository(tmpl_repo, args.dest)
@@ -78,343 +80,398 @@ def proj_create(args, config, _extra_args):
         if not osp.isdir(dpath):
             os.mkdir(dpath)
 
-    with shelve.open(osp.join(args.dest, '.em')) as emdb:
-        emdb['__em__'] = {}
+    db.create_project(args.dest)
 
 
-def _cleanup(name, emdb, repo):
-    exper_dir = _expath(name)
-    if name not in emdb and not osp.isdir(exper_dir):
-        return
-    if osp.isdir(exper_dir):
-        shutil.rmtree(exper_dir)
-    try:
-        worktree = repo.lookup_worktree(name)
-        if worktree is not None:
-            worktree.prune(True)
-    except pygit2.GitError:
-        pass
-        # worktree_dir = osp.join('.git', 'worktrees', name)
-        # if osp.isdir(worktree_dir):
-        #     shutil.rmtree(exper_dir)
-    try:
-        br = repo.lookup_branch(name)
-        if br is not None:
-            br.delete()
-    except pygit2.GitError:
-        pass
-    if name in emdb:
-        del emdb[name]
+def _forget(name, emdb):
+    """Removes the metadata of an experiment."""
+    exper_dir = util.expath(name)
+    db.set_stat_cache(emdb, exper_dir, {})
+    db.set_stat_cache(emdb, osp.join(exper_dir, 'run', 'snaps'), {})
+    db.delete(emdb, name)
 
 
-def _cleanup_snaps(name, _emdb, _repo):
-    exper_dir = _expath(name)
-    snaps_dir = osp.join(exper_dir, 'run', 'snaps')
-    if osp.isdir(snaps_dir):
-        shutil.rmtree(snaps_dir)
+def _remove(name, repo):
+    """Trashes an experiment and its git state; True if files were trashed."""
+    from em import trash
+    trashed = trash.move(util.expath(name), trash.trash_path())
+    sources.prune_worktree(repo, name)
+    br = util.get_branch(repo, name)
+    if br is not None:
+        br.delete()
+    archived_ref = repo.references.get(sources.ARCHIVE_REF.format(name))
+    if archived_ref is not None:
+        archived_ref.delete()
+    return trashed
+
+
+def _forget_snaps(name, emdb, keep_last=0, keep_every=0):
+    if not keep_last and not keep_every:
+        db.set_stat_cache(emdb, util.expath(name, 'run', 'snaps'), {})
+
+
+def _remove_snaps(name, _repo, keep_last=0, keep_every=0):
+    from em import store
+    from em import trash
+    snaps_dir = util.expath(name, 'run', 'snaps')
+    to_trash = functools.partial(trash.move, trash_dir=trash.trash_path())
+    if keep_last or keep_every:  # removed files may be store garbage
+        return bool(store.prune(snaps_dir, keep_last, keep_every, to_trash))
+    trashed = to_trash(snaps_dir)
+    if trashed:
         os.mkdir(snaps_dir)
+    return trashed
 
 
-def _tstamp():
-    import time
-    return datetime.datetime.fromtimestamp(time.time())
-
+def run(args, config, prog_args):
+    """Run an experiment."""
+    import pygit2
+    from em import trash
+    name = args.name
+    repo = pygit2.Repository('.')
 
-def _get_tracked_exts(config):
-    return set(config['experiment']['track_files'].split(','))
+    with db.connect() as emdb:
+        exp_info = db.get(emdb, name)
+    if exp_info:
+        if exp_info['status'] == 'running':
+            return util.die(E_IS_RUNNING.format(name))
+        newp = input(RUN_RECREATE_PROMPT.format(name))
+        if newp.lower() != 'y':
+            return
+    with db.connect() as emdb, db.transaction(emdb):
+        if exp_info:
+            _forget(name, emdb)
+        if not db.insert(emdb, name, {'status': 'starting'}):
+            return util.die(E_IS_RUNNING.format(name))
+    if exp_info and _remove(name, repo):
+        trash.spawn_reaper()
 
-def _has_src_changes(repo, config):
-    has_src_changes = has_changes = False
-    for filepath, status in repo.status().items():
-        ext = osp.splitext(osp.basename(filepath))[1][1:]
-        changed = status not in GIT_UNCH
-        has_changes = has_changes or changed
-        if ext in _get_tracked_exts(config):
-            has_src_changes = has_src_changes or changed
-    return has_src_changes
+    br = util.get_branch(repo, name)
 
+    base_commit = None
+    if br is not None:
+        if br.is_checked_out():
+            return util.die(E_CHECKED_OUT)
+        base_commit = repo[br.target]
+        br.delete()
 
-def _create_experiment(name, repo, config, base_commit=None, desc=None):
-    # pylint: disable=too-many-locals
-    head_commit = repo[repo.head.target]
-    stash = None
-    sig = repo.default_signature
-
-    has_src_changes = _has_src_changes(repo, config)
-
-    if has_src_changes:
-        repo.index.add_all([f'*.{ext}' for ext in _get_tracked_exts(config)])
-        snap_tree_id = repo.index.write_tree()  # an Oid
-
-        if base_commit is not None:
-            if base_commit.tree_id != snap_tree_id:
-                stash = repo.stash(sig, include_untracked=True)
-        else:  # look for identical experiment commit
-            base_commit = head_commit
-            with shelve.open('.em') as emdb:
-                for existing_name in emdb:
-                    existing_br = repo.lookup_branch(existing_name)
-                    if existing_br is None:
-                        continue
-                    existing_ci = existing_br.get_object()
-                    if existing_ci and existing_ci.tree_id == snap_tree_id:
-                        base_commit = existing_ci
-                        break
-    else:
-        base_commit = head_commit
+    sources.create_experiment(name, repo, config, base_commit,
+                              desc=args.desc, timing=args.timing,
+                              link_mode=args.link, sparse=args.sparse)
 
-    if base_commit != head_commit:
-        repo.reset(base_commit.id,
-                   pygit2.GIT_RESET_HARD if stash else pygit2.GIT_RESET_SOFT)
+    if args.queue:
+        return _enqueue(name, args, prog_args)
+    return jobs.run_job(name, config, args.gpu, prog_args, args.background)
 
-    exper_dir = _expath(name)
-    repo.add_worktree(name, exper_dir)
 
-    if has_src_changes and base_commit == head_commit:
-        # create a snapshot and move the worktree branch to it
-        repo.create_commit(f'refs/heads/{name}', sig, sig,
-                           desc or 'setup experiment',
-                           snap_tree_id, [base_commit.id])
-        # update the workdir to match updated index
-        workdir = pygit2.Repository(exper_dir)
-        workdir.reset(workdir.head.target, pygit2.GIT_RESET_HARD)
+def _enqueue(name, args, prog_args):
+    with db.connect() as emdb:
+        sched.enqueue(emdb, name, prog_args, priority=args.priority,
+                      nslots=args.nslots, queued_at=util.tstamp())
 
-    os.symlink(osp.abspath('data'), osp.join(exper_dir, 'data'),
-               target_is_directory=True)
 
-    if base_commit != head_commit:
-        repo.reset(head_commit.id,
-                   pygit2.GIT_RESET_HARD if stash else pygit2.GIT_RESET_SOFT)
-        if stash:
-            repo.stash_pop()
+def _sweep_args(args):
+    """Returns the list of per-experiment program arguments of a sweep."""
+    import itertools
+    import shlex
 
+    list_args = [[]]
+    if args.list:
+        with open(args.list) as f_list:
+            list_args = [shlex.split(line) for line in f_list
+                         if line.strip() and not line.startswith('#')]
 
-def _run_job(name, config, gpu=None, prog_args=None, background=False):
-    import socket
-    import subprocess
-    import daemon
+    grid_axes = []
+    for axis in args.grid:
+        key, _, vals = axis.partition('=')
+        grid_axes.append([[f'--{key}', val] for val in vals.split(',')])
 
-    exper_dir = _expath(name)
+    return [base + sum(grid_point, [])
+            for base in list_args
+            for grid_point in itertools.product(*grid_axes)]
 
-    runem_cmd = ([config['experiment']['prog']] +
-                 config['experiment']['prog_args'] +
-                 (prog_args or []))
-    env = os.environ
-    if gpu:
-        env['CUDA_VISIBLE_DEVICES'] = gpu
 
-    def _do_run_job():
-        try:
-            job = subprocess.Popen(runem_cmd, cwd=exper_dir, env=env,
-                                   stdin=sys.stdin, stdout=sys.stdout,
-                                   stderr=sys.stderr)
-            with shelve.open('.em', writeback=True) as emdb:
-                emdb[name] = {
-                    'started': _tstamp(),
-                    'status': 'running',
-                    'pid': job.pid,
-                    'hostname': socket.getfqdn(),
-                }
-                if gpu:
-                    emdb[name]['gpu'] = gpu
-            job.wait()
-            with shelve.open('.em', writeback=True) as emdb:
-                status = 'completed' if job.returncode == 0 else 'error'
-                emdb[name]['status'] = status
-        except KeyboardInterrupt:
-            with shelve.open('.em', writeback=True) as emdb:
-                emdb[name]['status'] = 'interrupted'
-        finally:
-            with shelve.open('.em', writeback=True) as emdb:
-                emdb[name].pop('pid', None)
-                emdb[name]['ended'] = _tstamp()
-
-    if background:
-        curdir = osp.abspath(os.curdir)
-        with daemon.DaemonContext(working_directory=curdir):
-            _do_run_job()
-    else:
-        _do_run_job()
+def sweep(args, config, prog_args):
+    """Launch a sweep of experiments from one source snapshot."""
+    import pygit2
 
+    sweep_args = _sweep_args(args)
+    if not sweep_args or sweep_args == [[]]:
+        return util.die(E_EMPTY_SWEEP)
+    width = len(str(len(sweep_args) - 1))
+    names = [f'{args.name}-{i:0{width}d}' for i in range(len(sweep_args))]
 
-def run(args, config, prog_args):
-    """Run an experiment."""
-    name = args.name
     repo = pygit2.Repository('.')
+    for name in names:
+        if util.get_branch(repo, name) is not None:
+            return util.die(E_BRANCH_EXISTS.format(name))
+    # the rows claim the names before any branch or worktree is made
+    with db.connect() as emdb, db.transaction(emdb):
+        existing = db.names(emdb) & set(names)
+        if existing:
+            return util.die(E_NAME_EXISTS.format(min(existing)))
+        for name, exp_args in zip(names, sweep_args):
+            db.insert(emdb, name, {
+                'status': 'starting',
+                'desc': args.desc,
+                'sweep': args.name,
+                'prog_args': exp_args,
+            })
 
-    with shelve.open('.em', writeback=True) as emdb:
-        exp_info = emdb.get(name)
-        if exp_info:
-            if exp_info['status'] == 'running':
-                return _die(E_IS_RUNNING.format(name))
-            newp = input(RUN_RECREATE_PROMPT.format(name))
-            if newp.lower() != 'y':
-                return
-            _cleanup(name, emdb, repo)
-            br = None
-        emdb[name] = {'status': 'starting'}
-
-        try:
-            br = repo.lookup_branch(name)
-        except pygit2.GitError:
-            br = None
-
-    base_commit = None
-    if br is not None:
-        if br.is_checked_out():
-            return _die(E_CHECKED_OUT)
-        base_commit = repo[br.target]
-        br.delete()
-
-    _create_experiment(name, repo, config, base_commit, desc=args.desc)
-
-    return _run_job(name, config, args.gpu, prog_args, args.background)
+    try:
+        exper_commit = sources.snapshot_commit(repo, config, desc=args.desc,
+                                               timing=args.timing)
+        sources.setup_sweep_dirs(names, exper_commit, config, args.link,
+                                 args.sparse, args.jobs)
+    except BaseException:
+        # the rows would otherwise stay 'starting' with no sources
+        with db.connect() as emdb, db.transaction(emdb):
+            for name in names:
+                db.transition(emdb, name, 'error', from_status='starting')
+        raise
+
+    with db.connect() as emdb, db.transaction(emdb):
+        for name, exp_args in zip(names, sweep_args):
+            db.add_snapshot(emdb, name, exper_commit.tree_id,
+                            exper_commit.id)
+            if args.queue:
+                sched.enqueue(emdb, name, prog_args + exp_args,
+                              priority=args.priority, nslots=args.nslots,
+                              queued_at=util.tstamp())
+
+    if args.queue:
+        return
+    for name, exp_args in zip(names, sweep_args):
+        jobs.run_job(name, config, args.gpu, prog_args + exp_args,
+                     background=True)
 
 
 def fork(args, config, _extra_args):
     """Fork an experiment."""
+    import pygit2
     name = args.name
     fork_name = args.fork_name
     repo = pygit2.Repository('.')
 
-    with shelve.open('.em', writeback=True) as emdb:
-        if fork_name in emdb:
-            return _die(E_NAME_EXISTS.format(fork_name))
+    with db.connect() as emdb, db.transaction(emdb):
+        if db.get(emdb, fork_name) is not None:
+            return util.die(E_NAME_EXISTS.format(fork_name))
 
-        exp_info = emdb.get(name)
+        exp_info = db.get(emdb, name)
         if not exp_info:
-            return _die(E_NO_EXP.format(name))
+            return util.die(util.E_NO_EXP.format(name))
 
         try:
             fork_br = repo.lookup_branch(fork_name)
             if fork_br is not None:
-                return _die(E_BRANCH_EXISTS.format(fork_name))
+                return util.die(E_BRANCH_EXISTS.format(fork_name))
         except pygit2.GitError:
             pass
 
-        try:
-            br = repo.lookup_branch(name)
-        except pygit2.GitError:
-            br = None
-        if br is None:
-            return _die(E_NO_BRANCH.format(name))
+        base_commit = sources.experiment_commit(repo, name)
+        if base_commit is None:
+            return util.die(util.E_NO_BRANCH.format(name))
 
-        emdb[fork_name] = {
+        db.insert(emdb, fork_name, {
             'status': 'starting',
             'clone_of': name,
-        }
-
-    base_commit = repo[br.target]
-    _create_experiment(fork_name, repo, config, base_commit)
-
-    fork_snap_dir = osp.join(_expath(fork_name), 'run', 'snaps')
-    os.makedirs(fork_snap_dir)
-
-    def _link(*path_comps):
-        orig_path = osp.join(_expath(name), *path_comps)
-        os.symlink(orig_path, orig_path.replace(name, fork_name))
-
-    _link('run', 'opts.pkl')
-    orig_snap_dir = fork_snap_dir.replace(fork_name, name)
-    for snap_name in os.listdir(orig_snap_dir):
-        _link('run', 'snaps', snap_name)
+        })
+
+    sources.create_experiment(fork_name, repo, config, base_commit,
+                              link_mode=args.link, sparse=args.sparse)
+
+    os.makedirs(util.expath(fork_name, 'run'), exist_ok=True)
+    os.symlink(util.expath(name, 'run', 'opts.pkl'),
+               util.expath(fork_name, 'run', 'opts.pkl'))
+
+    # the snaps are hardlinked, so the fork does not depend on the original;
+    # `store.unshare` copies them before either experiment resumes, and they
+    # are stored when one of them next finishes
+    orig_snap_dir = util.expath(name, 'run', 'snaps')
+    fork_snap_dir = util.expath(fork_name, 'run', 'snaps')
+    if osp.isdir(orig_snap_dir):
+        from em import store
+        store.link_all(orig_snap_dir, fork_snap_dir)
+    else:
+        os.makedirs(fork_snap_dir)
 
 
 def resume(args, config, prog_args):
     """Resume a stopped experiment."""
+    import pygit2
     name = args.name
 
     repo = pygit2.Repository('.')
 
-    with shelve.open('.em') as emdb:
-        if name not in emdb:
-            return _die(E_NO_EXP.format(name))
-        info = emdb[name]
+    with db.connect() as emdb:
+        info = db.get(emdb, name)
+        if info is None:
+            return util.die(util.E_NO_EXP.format(name))
         if 'pid' in info or info.get('status') == 'running':
-            return _die(E_IS_RUNNING.format(name))
-        try:
-            repo.lookup_branch(name)
-        except pygit2.GitError:
-            return _die(E_NO_EXP.format(name))
+            return util.die(E_IS_RUNNING.format(name))
+        if sources.experiment_commit(repo, name) is None:
+            return util.die(util.E_NO_EXP.format(name))
+    sources.rehydrate(name, repo, config)
 
     prog_args.append('--resume')
     if args.epoch:
         prog_args.append(args.epoch)
 
-    return _run_job(name, config, args.gpu, prog_args, args.background)
+    if args.queue:
+        return _enqueue(name, args, prog_args)
+    return jobs.run_job(name, config, args.gpu, prog_args, args.background)
+
+
+def _print_queue(emdb):
+    for pos, (name, info) in enumerate(sched.queued(emdb), 1):
+        print(f'{pos:3d}. {name} (priority {info.get("priority", 0)}, '
+              f'{info.get("nslots", 1)} slots)')
+
+
+def queue(args, config, _extra_args):
+    """Launch queued experiments as resource slots become free."""
+    import time
+
+    if args.list:
+        with db.connect() as emdb:
+            _print_queue(emdb)
+        return
+
+    qconf = config['queue']
+    slots = (args.slots or qconf['slots']).split(',')
+    if slots == ['']:
+        return util.die(E_NO_SLOTS)
+    kind = args.kind or qconf['kind']
+    max_jobs = qconf['max_jobs'] if args.max_jobs is None else args.max_jobs
+
+    def _schedule_loop():
+        while True:
+            with db.connect() as emdb:
+                launches = sched.schedule(emdb, slots, max_jobs)
+                # experiments that need more slots than there are never run
+                is_drained = not launches and all(
+                    (info.get('nslots') or 1) > len(slots)
+                    for _name, info in sched.queued(emdb))
+            jobs.launch_queued(launches, kind, config)
+            if args.once or (args.drain and is_drained):
+                return
+            time.sleep(args.interval)
+
+    if args.background:
+        import daemon
+        curdir = osp.abspath(os.curdir)
+        with daemon.DaemonContext(working_directory=curdir,
+                                  detach_process=True):
+            _schedule_loop()
+    else:
+        _schedule_loop()
+
+
+def supervise(args, _config, _extra_args):
+    """Run the supervisor of background jobs."""
+    from em import supervisor
+    if args.stop:
+        reply = supervisor.request({'op': 'stop'})
+        if reply is None:
+            return util.die(E_NO_SUPERVISOR)
+        if not reply['ok']:
+            return util.die(jobs.E_SUPERVISOR.format(reply['error']))
+        if reply['jobs']:
+            print(SUPERVISOR_STOPPING.format(len(reply['jobs'])))
+        return
+    if supervisor.is_running():
+        return util.die(E_SUPERVISOR_RUNNING)
+
+    if args.background:
+        import daemon
+        curdir = osp.abspath(os.curdir)
+        with daemon.DaemonContext(working_directory=curdir,
+                                  detach_process=True):
+            supervisor.serve()
+    else:
+        supervisor.serve()
 
 
 def _print_sorted(lines, tmpl=LI):
     print('\n'.join(map(tmpl.format, sorted(lines))))
 
 
-def clean(args, _config, _extra_args):
-    """Clean up experiments."""
+def _match_clean(emdb, args):
+    """Returns the matched experiments and those that need --force."""
     from fnmatch import fnmatch
-    repo = pygit2.Repository('.')
+    matched = set()
+    needs_force = set()
+    for name, info in db.items(emdb):
+        is_match = sum(fnmatch(name, patt) for patt in args.name)
+        is_excluded = sum(fnmatch(name, patt) for patt in args.exclude)
+        if not is_match or is_excluded:
+            continue
+        matched.add(name)
+        if 'pid' in info or info.get('status') == 'running':
+            needs_force.add(name)
+    return matched, needs_force
 
-    cleanup = _cleanup_snaps if args.snaps else _cleanup
 
-    with shelve.open('.em', writeback=True) as emdb:
-        matched = set()
-        needs_force = set()
-        for name in emdb:
-            if name == EM_KEY:
-                continue
-            is_match = sum(fnmatch(name, patt) for patt in args.name)
-            is_excluded = sum(fnmatch(name, patt) for patt in args.exclude)
-            if not is_match or is_excluded:
-                continue
-            matched.add(name)
-            info = emdb[name]
-            if 'pid' in info or info.get('status') == 'running':
-                needs_force.add(name)
+def clean(args, _config, _extra_args):
+    """Clean up experiments."""
+    # pylint: disable=too-many-locals
+    import pygit2
+    from em import trash
+    repo = pygit2.Repository('.')
+    forget, remove = _forget, _remove
+    if args.snaps:
+        keep = {'keep_last': args.keep_last, 'keep_every': args.keep_every}
+        forget = functools.partial(_forget_snaps, **keep)
+        remove = functools.partial(_remove_snaps, **keep)
+
+    with db.connect() as emdb:
+        matched, needs_force = _match_clean(emdb, args)
         if not matched:
             return
         clean_noforce = matched - needs_force
         to_clean = clean_noforce if not args.force else matched
-        if len(args.name) == 1 and args.name[0] in to_clean:
-            cleanup(args.name[0], emdb, repo)
-            return
-
         if not to_clean:
             return
-
-        print(CLEAN_SNAP_PREAMBLE if args.snaps else CLEAN_PREAMBLE)
-        _print_sorted(clean_noforce)
-        if args.force:
-            _print_sorted(needs_force, tmpl=LI_RUNNING)
-        elif needs_force:
-            print(CLEAN_NEEDS_FORCE)
-            _print_sorted(needs_force)
-
-        prompt = CLEAN_SNAPS_PROMPT if args.snaps else CLEAN_PROMPT
-        cleanp = input(prompt.format(len(to_clean)))
-        if cleanp.lower() != 'y':
-            return
-        for name in to_clean:
-            try:
-                cleanup(name, emdb, repo)
-            except OSError:
-                print(E_CANT_CLEAN.format(name))
+        if len(args.name) != 1 or args.name[0] not in to_clean:
+            print(CLEAN_SNAP_PREAMBLE if args.snaps else CLEAN_PREAMBLE)
+            _print_sorted(clean_noforce)
+            if args.force:
+                _print_sorted(needs_force, tmpl=LI_RUNNING)
+            elif needs_force:
+                print(CLEAN_NEEDS_FORCE)
+                _print_sorted(needs_force)
+            prompt = CLEAN_SNAPS_PROMPT if args.snaps else CLEAN_PROMPT
+            if input(prompt.format(len(to_clean))).lower() != 'y':
+                return
+        # files are only trashed once their metadata is gone for good
+        with db.transaction(emdb):
+            for name in to_clean:
+                forget(name, emdb)
+    needs_reaping = False
+    for name in sorted(to_clean):
+        try:
+            needs_reaping |= remove(name, repo)
+        except (OSError, pygit2.GitError):
+            print(E_CANT_CLEAN.format(name))
+    if needs_reaping:
+        trash.spawn_reaper()
 
 
 def reset(args, _config, _extra_args):
     """Reset the state of [glitched] experiments."""
     from fnmatch import fnmatch
 
-    with shelve.open('.em', writeback=True) as emdb:
+    with db.connect() as emdb:
         def _reset(name):
-            for state_item in ['pid', 'gpu']:
-                emdb[name].pop(state_item, None)
-            emdb[name]['status'] = 'reset'
+            db.transition(emdb, name, 'reset', pid=None, gpu=None)
 
-        if len(args.name) == 1 and args.name[0] in emdb:  # non-globbed
+        exp_names = db.names(emdb)
+        if len(args.name) == 1 and args.name[0] in exp_names:  # non-globbed
             _reset(args.name[0])
             return
 
         to_reset = set()
-        for name in emdb:
+        for name in exp_names:
             is_match = sum(fnmatch(name, patt) for patt in args.name)
             is_excluded = sum(fnmatch(name, patt) for patt in args.exclude)
             if not is_match or is_excluded:
@@ -428,154 +485,177 @@ def reset(args, _config, _extra_args):
         resetp = input(RESET_PROMPT.format(len(to_reset)))
         if resetp.lower() != 'y':
             return
-        for name in to_reset:
-            _reset(name)
-
-
-def list_experiments(args, _config, _extra_args):
-    """List experiments."""
-    import subprocess
-
-    if args.filter:
-        filter_key, filter_value = args.filter.split('=')
-
-        def _filt(stats):
-            return filter_key in stats and stats[filter_key] == filter_value
-
-    with shelve.open('.em') as emdb:
-        if args.filter:
-            names = {name
-                     for name, info in sorted(emdb.items()) if _filt(info)}
-        else:
-            names = emdb.keys()
-        names -= {EM_KEY}
-        if not names:
-            return
+        with db.transaction(emdb):
+            for name in to_reset:
+                _reset(name)
 
-    subprocess.run(
-        ['column'], input='\n'.join(sorted(names)) + '\n', encoding='utf8')
-
-
-def show(args, _config, _extra_args):
-    """Show details about an experiment."""
-    import pickle
-    import pprint
-
-    name = args.name
-
-    with shelve.open('.em') as emdb:
-        if name not in emdb or name == EM_KEY:
-            return _die(E_NO_EXP.format(name))
-        for info_name, info_val in sorted(emdb[name].items()):
-            if isinstance(info_val, datetime.date):
-                info_val = info_val.ctime()
-            print(f'{info_name}: {info_val}')
-
-    if not args.opts:
-        return
-
-    opts_path = _expath(name, 'run', 'opts.pkl')
-    with open(opts_path, 'rb') as f_opts:
-        print('\noptions:')
-        opts = pickle.load(f_opts)
-        cols = shutil.get_terminal_size((80, 20)).columns
-        pprint.pprint(vars(opts), indent=2, compact=True, width=cols)
 
+def reap(args, _config, _extra_args):
+    """Mark experiments whose jobs died without a trace as interrupted."""
+    import socket
 
-def _ps(pid):
-    try:
-        os.kill(pid, 0)
-    except OSError:
-        return False
-    return True
+    with db.connect() as emdb:
+        stale = sched.reap(emdb, socket.getfqdn(), args.stale_secs,
+                           dry_run=args.dry_run)
+    if stale:
+        print(REAP_PREAMBLE)
+        _print_sorted(stale)
 
 
-def ctl(args, _config, _extra_args):
-    """Send a command to a running experiment."""
+def _send_ctl(name, info, is_alive, cmd, hostname):
+    """Sends a command to an experiment. Returns (error, reply)."""
+    # pylint: disable=too-many-return-statements
     import signal
+    from em import control
+
+    if info is None:
+        return util.E_NO_EXP.format(name), None
+    pid = info.get('pid')
+    if not pid or is_alive is None:
+        return E_IS_NOT_RUNNING.format(name), None
+    if not is_alive:
+        return E_STALE.format(name), None
+
+    is_local = info.get('hostname') == hostname
+    if cmd[0] == 'stop':
+        if not is_local:
+            return E_OTHER_MACHINE.format(name), None
+        os.kill(pid, signal.SIGINT)
+        return None, None
+    if is_local:  # sockets do not work across the hosts sharing a project
+        try:
+            answer = control.send(util.expath(name, 'run'), cmd)
+        except TimeoutError:
+            return E_CTL_TIMEOUT.format(name), None
+        if answer is not None:
+            if not answer.get('ok'):
+                return E_CTL_FAILED.format(name, answer.get('reply')), None
+            return None, answer.get('reply')
+    try:  # for programs that poll the ctl file
+        with open(util.expath(name, 'run', 'ctl'), 'w') as f_ctl:
+            print(' '.join(cmd), file=f_ctl)
+    except OSError as err:
+        return str(err), None
+    return None, None
+
+
+def _print_ctl_replies(names, results):
+    """Prints the replies of experiments to a command. Returns the exit
+    status of `em ctl`."""
+    import json
+    status = 0
+    for name, (error, reply) in zip(names, results):
+        if error:
+            status = util.die(error)
+            continue
+        if reply is not None and not isinstance(reply, str):
+            reply = json.dumps(reply)
+        if len(names) > 1:
+            print(f'{name}: {reply or "ok"}')
+        elif reply is not None:
+            print(reply)
+    return status
 
-    name = args.name
 
-    with shelve.open('.em') as emdb:
-        if name not in emdb:
-            return _die(E_NO_EXP.format(name))
-        pid = emdb[name].get('pid')
-        if not pid:
-            return _die(E_IS_NOT_RUNNING.format(name))
-        if not _ps(pid):
-            return _die(E_OTHER_MACHINE.format(name))
-
-    cmd = args.cmd[0]
-    if cmd == 'stop':
-        os.kill(pid, signal.SIGINT)
-    else:
-        ctl_file = _expath(name, 'run', 'ctl')
-        with open(ctl_file, 'w') as f_ctl:
-            print(' '.join(args.cmd), file=f_ctl)
+def ctl(args, _config, _extra_args):
+    """Send a command to running experiments."""
+    from concurrent.futures import ThreadPoolExecutor
+    from fnmatch import fnmatch
+    import socket
 
+    hostname = socket.getfqdn()
+    with db.connect() as emdb:
+        alive = sched.liveness(emdb, hostname)
+        if db.get(emdb, args.name) is not None:
+            names = [args.name]
+        else:  # a pattern matches only running experiments
+            names = sorted(name for name in alive if fnmatch(name, args.name))
+        if not names:
+            return util.die(util.E_NO_EXP.format(args.name))
+        infos = [db.get(emdb, name) for name in names]
 
-def _get_br(repo, branch_name):
-    br = None
-    try:
-        br = repo.lookup_branch(branch_name)
-    except pygit2.GitError:
-        pass
-    return br
+    with ThreadPoolExecutor(max_workers=min(len(names), CTL_WORKERS)) as pool:
+        results = list(pool.map(
+            _send_ctl, names, infos, map(alive.get, names),
+            [args.cmd] * len(names), [hostname] * len(names)))
+    return _print_ctl_replies(names, results)
 
 
-def rename(args, _config, _extra_args):
+def rename(args, config, _extra_args):
     """Rename an experiment."""
     # pylint: disable=too-many-return-statements
+    import pygit2
     repo = pygit2.init_repository('.')
 
     name = args.name
     new_name = args.newname
 
-    with shelve.open('.em') as emdb:
-        if name not in emdb:
-            return _die(E_NO_EXP.format(name))
-        if emdb[name]['status'] == 'running':
-            return _die(E_RENAME_RUNNING)
-        if new_name in emdb:
-            return _die(E_NAME_EXISTS.format(new_name))
-
-    br = _get_br(repo, name)
+    with db.connect() as emdb:
+        info = db.get(emdb, name)
+        if info is None:
+            return util.die(util.E_NO_EXP.format(name))
+        if info['status'] == 'running':
+            return util.die(E_RENAME_RUNNING)
+        if db.get(emdb, new_name) is not None:
+            return util.die(E_NAME_EXISTS.format(new_name))
+
+    sources.rehydrate(name, repo, config)
+    br = util.get_branch(repo, name)
     if br is None:
-        return _die(E_NO_BRANCH.format(name))
-    if _get_br(repo, new_name) is not None:
-        return _die(E_BRANCH_EXISTS.format(new_name))
+        return util.die(util.E_NO_BRANCH.format(name))
+    if util.get_branch(repo, new_name) is not None:
+        return util.die(E_BRANCH_EXISTS.format(new_name))
 
-    exper_dir = _expath(name)
-    new_exper_dir = _expath(new_name)
+    exper_dir = util.expath(name)
+    new_exper_dir = util.expath(new_name)
     try:
         os.rename(exper_dir, new_exper_dir)
     except OSError:
-        return _die(E_MOVE_DIR)
+        return util.die(E_MOVE_DIR)
 
     try:
         br.rename(new_name)
     except pygit2.GitError:
         os.rename(new_exper_dir, exper_dir)
-        return _die(E_RENAME_BRANCH)
+        return util.die(E_RENAME_BRANCH)
 
-    with shelve.open('.em') as emdb:
-        emdb[new_name] = emdb.pop(name)
+    with db.connect() as emdb:
+        db.rename(emdb, name, new_name)
+        db.set_stat_cache(emdb, exper_dir, {})
 
 
-def main():
-    # pylint: disable=too-many-statements
-    """Runs the program."""
-    parser = argparse.ArgumentParser(
-        description='Manage projects and experiments.')
-    parser.add_argument('--config', '-c', help='path to config file')
-    subparsers = parser.add_subparsers()
+def _add_checkout_args(parser):
+    from em import snapshot
+    parser.add_argument('--link', choices=snapshot.LINK_MODES,
+                        help='reuse files checked out by other experiments '
+                        'via reflinks or hardlinks (hardlinked files are '
+                        'shared, so edit them only by replacing them)')
+    parser.add_argument('--sparse', action='store_true',
+                        help='only check out files with tracked extensions')
+
+
+def _add_queue_args(parser):
+    parser.add_argument('--queue', '-q', action='store_true',
+                        help='wait for a slot from the em queue')
+    parser.add_argument('--priority', '-p', type=int, default=0,
+                        help='queue priority; higher runs first')
+    parser.add_argument('--nslots', type=int, default=1,
+                        help='number of queue slots needed')
+
 
+def _add_sample_args(parser):
+    parser.add_argument('--sample', type=float, metavar='SECS',
+                        help='record the resource usage of jobs every SECS '
+                        'seconds (see `em stats`)')
 
+
+def _add_proj_parser(subparsers):
     parser_create = subparsers.add_parser('proj', help='create a new project')
     parser_create.add_argument('dest', help='the project destination')
     parser_create.set_defaults(em_cmd=proj_create)
 
 
+def _add_run_parser(subparsers):
     parser_run = subparsers.add_parser('run', help='run an experiment')
     parser_run.add_argument('name', help='the name of the experiment')
     parser_run.add_argument('--gpu', '-g',
@@ -584,23 +664,59 @@ def main():
                             help='run the experiment in the background')
     parser_run.add_argument('--desc',
                             help='a short description of any source changes')
+    parser_run.add_argument('--timing', action='store_true',
+                            help='report time spent scanning for changes')
+    _add_checkout_args(parser_run)
+    _add_queue_args(parser_run)
+    _add_sample_args(parser_run)
     parser_run.set_defaults(em_cmd=_ensure_proj(run))
 
 
+def _add_sweep_parser(subparsers):
+    parser_sweep = subparsers.add_parser(
+        'sweep', help='run a batch of experiments from one snapshot')
+    parser_sweep.add_argument('name',
+                              help='the name prefix of the experiments')
+    parser_sweep.add_argument('--grid', nargs='+', default=[],
+                              metavar='KEY=V1,V2',
+                              help='pass --KEY <V> for all combinations')
+    parser_sweep.add_argument('--list', metavar='FILE',
+                              help='file with the arguments of one '
+                              'experiment per line')
+    parser_sweep.add_argument('--gpu', '-g',
+                              help='CSV ids of gpus to use. none = all')
+    parser_sweep.add_argument('--desc',
+                              help='a short description of any source '
+                              'changes')
+    parser_sweep.add_argument('--jobs', '-j', type=int,
+                              help='number of worktrees to set up at once')
+    parser_sweep.add_argument('--timing', action='store_true',
+                              help='report time spent scanning for changes')
+    _add_checkout_args(parser_sweep)
+    _add_queue_args(parser_sweep)
+    _add_sample_args(parser_sweep)
+    parser_sweep.set_defaults(em_cmd=_ensure_proj(sweep))
+
+
+def _add_fork_parser(subparsers):
     parser_run = subparsers.add_parser('fork', help='fork an experiment')
     parser_run.add_argument('name', help='the name of the experiment to clone')
     parser_run.add_argument('fork_name', help='name for the cloned experiment')
+    _add_checkout_args(parser_run)
     parser_run.set_defaults(em_cmd=_ensure_proj(fork))
 
 
+def _add_ctl_parser(subparsers):
     parser_ctl = subparsers.add_parser('ctl',
-                                       help='control a running experiment')
-    parser_ctl.add_argument('name', help='the name of the experiment')
+                                       help='control running experiments')
+    parser_ctl.add_argument('name', help='the name of the experiment or a '
+                            'pattern of running experiments')
     parser_ctl.add_argument('cmd', nargs='+',
                             help='the control signal to send')
     parser_ctl.set_defaults(em_cmd=_ensure_proj(ctl))
 
 
+def _add_resume_parser(subparsers):
     parser_run = subparsers.add_parser('resume',
                                        help='resume existing experiment')
     parser_run.add_argument('name', help='the name of the experiment')
@@ -609,23 +725,106 @@ def main():
                             help='CSV ids of gpus to use. none = all')
     parser_run.add_argument('--background', '-bg', action='store_true',
                             help='resume the experiment into the background')
+    _add_queue_args(parser_run)
+    _add_sample_args(parser_run)
     parser_run.set_defaults(em_cmd=_ensure_proj(resume))
 
 
+def _add_queue_parser(subparsers):
+    parser_queue = subparsers.add_parser(
+        'queue', help='launch queued experiments on free resource slots')
+    parser_queue.add_argument('--slots', '-s',
+                              help='CSV ids of the gpus (or cpus) to use')
+    parser_queue.add_argument('--kind', choices=('gpu', 'cpu'),
+                              help='the kind of device the slots refer to')
+    parser_queue.add_argument('--max-jobs', '-j', type=int,
+                              help='max number of concurrent queued jobs')
+    parser_queue.add_argument('--interval', type=float, default=1,
+                              help='seconds between scheduling passes')
+    parser_queue.add_argument('--once', action='store_true',
+                              help='make a single scheduling pass')
+    parser_queue.add_argument('--drain', action='store_true',
+                              help='exit once the queue is empty')
+    parser_queue.add_argument('--list', '-l', action='store_true',
+                              help='just print the queue')
+    parser_queue.add_argument('--background', '-bg', action='store_true',
+                              help='run the scheduler in the background')
+    _add_sample_args(parser_queue)
+    parser_queue.set_defaults(em_cmd=_ensure_proj(queue))
+
+
+def _add_supervisor_parser(subparsers):
+    parser_sup = subparsers.add_parser(
+        'supervisor', help='run one process that owns all background jobs')
+    parser_sup.add_argument('--background', '-bg', action='store_true',
+                            help='run the supervisor in the background')
+    parser_sup.add_argument('--stop', action='store_true',
+                            help='stop the supervisor once its jobs exit')
+    parser_sup.set_defaults(em_cmd=_ensure_proj(supervise))
+
+
+def _add_list_parser(subparsers):
     parser_list = subparsers.add_parser('list', aliases=['ls'],
                                         help='list experiments')
-    parser_list.add_argument('--filter', '-f',
-                             help='filter experiments by <state>=<val>')
-    parser_list.set_defaults(em_cmd=_ensure_proj(list_experiments))
-
+    parser_list.add_argument('--filter', '-f', nargs='+', default=[],
+                             metavar='COND',
+                             help='only list experiments meeting conditions '
+                             'like status=running, started>2026-10-01, '
+                             'duration>2h or "status in (running,queued)"')
+    parser_list.add_argument('--sort', '--sort-by', '-s', default='name',
+                             help='the field to sort by, or a metric '
+                             'summary like val:loss:min (min, max, last, '
+                             'min_step, max_step, last_step, count or '
+                             'epochs), best first')
+    parser_list.add_argument('--reverse', '-r', action='store_true',
+                             help='sort in descending order')
+    parser_list.add_argument('--top', type=int, metavar='N',
+                             help='only list the first N experiments')
+    parser_list.add_argument('--refresh', action='store_true',
+                             help='first summarize the metrics written '
+                             'since the last update')
+    parser_list.add_argument('--cols',
+                             help='comma-separated fields to show, e.g. '
+                             'status,host,gpu,duration')
+    parser_list.set_defaults(em_cmd=_ensure_proj(report.list_experiments))
+
+
+def _add_show_parser(subparsers):
     parser_show = subparsers.add_parser('show',
                                         help='show details of an experiment')
     parser_show.add_argument('name', help='the name of the experiment')
     parser_show.add_argument('--opts', action='store_true',
                              help='also print runtime options')
-    parser_show.set_defaults(em_cmd=_ensure_proj(show))
-
-
+    parser_show.set_defaults(em_cmd=_ensure_proj(report.show))
+
+
+def _add_diff_parser(subparsers):
+    parser_diff = subparsers.add_parser(
+        'diff', help='show how experiments differ in source and options')
+    parser_diff.add_argument('name', nargs='+',
+                             help='two experiments, or patterns of the '
+                             'experiments to compare')
+    parser_diff.add_argument('--patch', '-p', action='store_true',
+                             help='print the source diff of two experiments')
+    parser_diff.set_defaults(em_cmd=_ensure_proj(compare.diff))
+
+
+def _add_table_parser(subparsers):
+    parser_table = subparsers.add_parser(
+        'table', help='compare the options of experiments')
+    parser_table.add_argument('name', nargs='*', default=['*'],
+                              help='patterns of experiments to compare')
+    parser_table.add_argument('--cols',
+                              help='comma-separated options to show '
+                              '(default: those that differ)')
+    parser_table.add_argument('--format', default='table',
+                              choices=('table', 'csv', 'tsv', 'json'),
+                              help='the output format; json is an object '
+                              'of columns')
+    parser_table.set_defaults(em_cmd=_ensure_proj(compare.table))
+
+
+def _add_clean_parser(subparsers):
     parser_clean = subparsers.add_parser('clean',
                                          help='clean up an experiment')
     parser_clean.add_argument('name', nargs='+',
@@ -635,9 +834,27 @@ def main():
     parser_clean.add_argument('--force', '-f', action='store_true')
     parser_clean.add_argument('--snaps', '-s', action='store_true',
                               help='just empty snaps directory?')
+    parser_clean.add_argument('--keep-last', type=int, default=0,
+                              metavar='K',
+                              help='with --snaps, keep the last K snaps')
+    parser_clean.add_argument('--keep-every', type=int, default=0,
+                              metavar='N',
+                              help='with --snaps, keep every N-th snap')
     parser_clean.set_defaults(em_cmd=_ensure_proj(clean))
 
 
+def _add_archive_parser(subparsers):
+    parser_archive = subparsers.add_parser(
+        'archive', help='remove the sources of finished experiments, '
+        'keeping their outputs (they are checked out again when needed)')
+    parser_archive.add_argument('name', nargs='+',
+                                help='patterns of experiments to archive')
+    parser_archive.add_argument('--exclude', '-e', nargs='+', default=[],
+                                help='patterns of experiments to keep')
+    parser_archive.set_defaults(em_cmd=_ensure_proj(sources.archive))
+
+
+def _add_reset_parser(subparsers):
     parser_clean = subparsers.add_parser('reset',
                                          help='reset glitched experiments')
     parser_clean.add_argument('name', nargs='+',
@@ -647,6 +864,35 @@ def main():
     parser_clean.set_defaults(em_cmd=_ensure_proj(reset))
 
 
+def _add_logs_parser(subparsers):
+    parser_logs = subparsers.add_parser(
+        'logs', help='print the output of an experiment')
+    parser_logs.add_argument('name', help='the name of the experiment')
+    parser_logs.add_argument('--follow', '-f', action='store_true',
+                             help='keep printing output until the job exits')
+    parser_logs.set_defaults(em_cmd=_ensure_proj(report.logs))
+
+
+def _add_stats_parser(subparsers):
+    parser_stats = subparsers.add_parser(
+        'stats', help='summarize the resources used by an experiment')
+    parser_stats.add_argument('name', help='the name of the experiment')
+    parser_stats.set_defaults(em_cmd=_ensure_proj(report.stats))
+
+
+def _add_reap_parser(subparsers):
+    parser_reap = subparsers.add_parser(
+        'reap', help='mark experiments whose jobs died as interrupted')
+    parser_reap.add_argument('--stale-secs', type=float,
+                             default=sched.STALE_SECS,
+                             help='age of the last heartbeat of a job on '
+                             'another host after which it is presumed dead')
+    parser_reap.add_argument('--dry-run', '-n', action='store_true',
+                             help='only list the experiments to reap')
+    parser_reap.set_defaults(em_cmd=_ensure_proj(reap))
+
+
+def _add_rename_parser(subparsers):
     parser_ctl = subparsers.add_parser('rename', aliases=['mv'],
                                        help='rename an experiment')
     parser_ctl.add_argument('name', help='the name of the experiment')
@@ -654,6 +900,62 @@ def main():
     parser_ctl.set_defaults(em_cmd=_ensure_proj(rename))
 
 
+COMMANDS = [
+    (('proj',), _add_proj_parser),
+    (('run',), _add_run_parser),
+    (('sweep',), _add_sweep_parser),
+    (('fork',), _add_fork_parser),
+    (('ctl',), _add_ctl_parser),
+    (('resume',), _add_resume_parser),
+    (('queue',), _add_queue_parser),
+    (('supervisor',), _add_supervisor_parser),
+    (('list', 'ls'), _add_list_parser),
+    (('show',), _add_show_parser),
+    (('table',), _add_table_parser),
+    (('diff',), _add_diff_parser),
+    (('logs',), _add_logs_parser),
+    (('stats',), _add_stats_parser),
+    (('clean',), _add_clean_parser),
+    (('archive',), _add_archive_parser),
+    (('reset',), _add_reset_parser),
+    (('reap',), _add_reap_parser),
+    (('rename', 'mv'), _add_rename_parser),
+]
+
+
+def _find_cmd(argv):
+    """Returns the subcommand named in `argv`, if any."""
+    args = iter(argv)
+    for arg in args:
+        if arg in ('--config', '-c'):
+            next(args, None)
+        elif not arg.startswith('-'):
+            return arg
+        elif arg in ('--help', '-h'):
+            return None
+    return None
+
+
+def _make_parser(argv):
+    """Builds the argument parser. Only the parser of the requested
+    subcommand is constructed, unless usage must be shown."""
+    parser = argparse.ArgumentParser(
+        description='Manage projects and experiments.')
+    parser.add_argument('--config', '-c', help='path to config file')
+    subparsers = parser.add_subparsers()
+
+    cmd = _find_cmd(argv)
+    is_known_cmd = any(cmd in cmd_names for cmd_names, _ in COMMANDS)
+    for cmd_names, add_parser in COMMANDS:
+        if not is_known_cmd or cmd in cmd_names:
+            add_parser(subparsers)
+    return parser
+
+
+def main():
+    """Runs the program."""
+    parser = _make_parser(sys.argv[1:])
+
     if len(sys.argv) == 1:
         parser.print_usage()
         exit()
@@ -667,11 +969,26 @@ def main():
         },
         'experiment': {
             'track_files': 'py,sh,txt',
+            'link_mode': 'copy',
+            'sparse': False,
             'prog': sys.executable,
             'prog_args': ['main.py'],
+            'sample_secs': 0,
+            'summary_stats': 'loss,val/loss',
+            # which stored checkpoints jobs get private copies of: 'auto',
+            # 'all' (a full copy per run without reflinks) or 'none'
+            'unshare_snaps': 'auto',
+        },
+        'queue': {
+            'slots': os.environ.get('CUDA_VISIBLE_DEVICES', ''),
+            'kind': 'gpu',
+            'max_jobs': 0,
         },
     }
 
+    if getattr(args, 'sample', None) is not None:
+        config['experiment']['sample_secs'] = args.sample
+
     try:
         ret = args.em_cmd(args, config, extra_args)
     except KeyboardInterrupt:
@@ -0,0 +1,107 @@
+"""Startup-time benchmark of the em CLI.
+
+Creates a throwaway project with many experiments and times an em command
+(`ls` by default) in fresh interpreters. Exits nonzero if the median wall
+time exceeds the budget, so it can gate changes to the CLI's startup path:
+
+    python -m em.bench --experiments 1000 --budget 0.2 [--importtime] [ls]
+"""
+import argparse
+import os
+from os import path as osp
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from em import db
+
+E_CMD_FAILED = 'error: `em {}` failed:\n{}'
+E_OVER_BUDGET = 'error: median {:.3f}s exceeds the budget of {:.3f}s'
+
+
+def _make_project(proj_dir, nexperiments):
+    db.create_project(proj_dir)
+    os.mkdir(osp.join(proj_dir, 'experiments'))
+    now = time.time()
+    with db.connect(proj_dir) as emdb, db.transaction(emdb):
+        for i in range(nexperiments):
+            db.insert(emdb, f'exp{i:05d}', {
+                'status': 'running' if i % 10 == 0 else 'completed',
+                'started': now - i * 60,
+                'ended': None if i % 10 == 0 else now - i * 30,
+                'hostname': f'node{i % 8}',
+                'gpu': str(i % 4),
+            })
+
+
+def _em_cmd(cmd, importtime=False):
+    pypath = osp.dirname(osp.dirname(osp.abspath(__file__)))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [pypath] + list(filter(None, [env.get('PYTHONPATH')])))
+    opts = ['-X', 'importtime'] if importtime else []
+    return [sys.executable] + opts + ['-m', 'em'] + cmd, env
+
+
+def _time_cmd(proj_dir, cmd):
+    argv, env = _em_cmd(cmd)
+    start = time.perf_counter()
+    proc = subprocess.run(argv, cwd=proj_dir, env=env,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                          universal_newlines=True)
+    elapsed = time.perf_counter() - start
+    if proc.returncode != 0:
+        raise RuntimeError(E_CMD_FAILED.format(' '.join(cmd), proc.stderr))
+    return elapsed
+
+
+def _top_imports(proj_dir, cmd, count=10):
+    argv, env = _em_cmd(cmd, importtime=True)
+    proc = subprocess.run(argv, cwd=proj_dir, env=env,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                          universal_newlines=True)
+    imports = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _self_us, cumulative_us, module = line[12:].split('|')
+        imports.append((int(cumulative_us), module.rstrip()))
+    return sorted(imports, reverse=True)[:count]
+
+
+def main():
+    """Runs the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('cmd', nargs='*', default=['ls'],
+                        help='the em command to time')
+    parser.add_argument('--experiments', '-n', type=int, default=1000,
+                        help='number of experiments in the project')
+    parser.add_argument('--runs', '-r', type=int, default=10,
+                        help='number of timed runs')
+    parser.add_argument('--budget', '-b', type=float, default=0.2,
+                        help='max median wall time in seconds')
+    parser.add_argument('--importtime', action='store_true',
+                        help='also print the slowest imports')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as proj_dir:
+        _make_project(proj_dir, args.experiments)
+        _time_cmd(proj_dir, args.cmd)  # warm up the page cache
+        times = [_time_cmd(proj_dir, args.cmd) for _ in range(args.runs)]
+        median = statistics.median(times)
+        print(f'em {" ".join(args.cmd)} ({args.experiments} experiments): '
+              f'min {min(times):.3f}s, median {median:.3f}s')
+        if args.importtime:
+            for cumulative_us, module in _top_imports(proj_dir, args.cmd):
+                print(f'{cumulative_us / 1e6:8.3f}s {module}')
+
+    if median > args.budget:
+        print(E_OVER_BUDGET.format(median, args.budget), file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
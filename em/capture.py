@@ -0,0 +1,177 @@
+"""Capture of the output of a job into rotated, compressed log segments.
+
+The job writes into a pipe. A reader thread drains the pipe into a bounded
+queue and a writer thread appends the queue to `run/stdout.log`, so a slow
+disk drops output rather than blocking the job. Once the log exceeds
+`MAX_BYTES`, it is renamed to `stdout.log.<n>` and compressed in the
+background with zstd (if the `zstandard` package is installed) or gzip.
+"""
+import gzip
+import os
+from os import path as osp
+import queue
+import re
+import shutil
+import threading
+import time
+
+LOG_FILE = 'stdout.log'
+
+MAX_BYTES = 64 << 20
+CHUNK_SIZE = 64 << 10
+MAX_CHUNKS = 256  # buffers up to 16 MiB of output
+
+COMPRESSED_EXTS = ('.zst', '.gz')
+
+DROPPED_MSG = '\n[em: dropped {:d} bytes of output]\n'
+
+_SEGMENT_RE = re.compile(re.escape(LOG_FILE) + r'\.(\d+)(\.zst|\.gz)?$')
+
+
+def _segment_nums(run_dir):
+    nums = {}
+    for filename in os.listdir(run_dir):
+        match = _SEGMENT_RE.match(filename)
+        if match:
+            nums.setdefault(int(match.group(1)), filename)
+    return nums
+
+
+def segments(run_dir):
+    """Returns the paths of the log segments of a run, oldest first.
+
+    The last is the log currently being written, if any."""
+    if not osp.isdir(run_dir):
+        return []
+    paths = [osp.join(run_dir, filename)
+             for _num, filename in sorted(_segment_nums(run_dir).items())]
+    if osp.exists(osp.join(run_dir, LOG_FILE)):
+        paths.append(osp.join(run_dir, LOG_FILE))
+    return paths
+
+
+def open_segment(path):
+    """Opens a (possibly compressed) log segment for binary reading."""
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    if path.endswith('.zst'):
+        import zstandard
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'))
+    return open(path, 'rb')
+
+
+def _compress(path):
+    try:
+        import zstandard
+        ext = '.zst'
+    except ImportError:
+        zstandard = None
+        ext = '.gz'
+    tmp_path = f'{path}{ext}.tmp'
+    with open(path, 'rb') as f_in:
+        if zstandard is not None:
+            with open(tmp_path, 'wb') as f_out:
+                zstandard.ZstdCompressor().copy_stream(f_in, f_out)
+        else:
+            with gzip.open(tmp_path, 'wb') as f_out:
+                shutil.copyfileobj(f_in, f_out)
+    os.replace(tmp_path, path + ext)
+    os.remove(path)
+
+
+class Capture:
+    """Copies what is written to the pipe `read_fd` into the logs of
+    `run_dir`."""
+
+    def __init__(self, read_fd, run_dir, max_bytes=MAX_BYTES):
+        os.makedirs(run_dir, exist_ok=True)
+        self.run_dir = run_dir
+        self.path = osp.join(run_dir, LOG_FILE)
+        self.max_bytes = max_bytes
+        self.ndropped = 0
+        self._read_fd = read_fd
+        self._chunks = queue.Queue(MAX_CHUNKS)
+        self._compressors = []
+        self._threads = [threading.Thread(target=self._read, daemon=True),
+                         threading.Thread(target=self._write, daemon=True)]
+        for thread in self._threads:
+            thread.start()
+
+    def _read(self):
+        try:
+            while True:
+                chunk = os.read(self._read_fd, CHUNK_SIZE)
+                if not chunk:
+                    break
+                try:
+                    self._chunks.put_nowait(chunk)
+                except queue.Full:
+                    self.ndropped += len(chunk)
+        finally:
+            os.close(self._read_fd)
+            self._chunks.put(None)
+
+    def _rotate(self):
+        nums = _segment_nums(self.run_dir)
+        segment_path = f'{self.path}.{max(nums, default=0) + 1}'
+        os.rename(self.path, segment_path)
+        compressor = threading.Thread(target=_compress, args=(segment_path,))
+        compressor.start()
+        self._compressors.append(compressor)
+
+    def _write(self):
+        nreported = 0
+        f_log = open(self.path, 'ab')
+        try:
+            for chunk in iter(self._chunks.get, None):
+                if self.ndropped > nreported:
+                    f_log.write(DROPPED_MSG.format(
+                        self.ndropped - nreported).encode())
+                    nreported = self.ndropped
+                f_log.write(chunk)
+                f_log.flush()  # so that `em logs --follow` sees it
+                if f_log.tell() >= self.max_bytes:
+                    f_log.close()
+                    self._rotate()
+                    f_log = open(self.path, 'ab')
+        finally:
+            f_log.close()
+
+    def join(self):
+        """Waits until the pipe is closed and all output is written."""
+        for thread in self._threads + self._compressors:
+            thread.join()
+
+
+def follow(run_dir, out, is_running, interval=0.5):
+    """Writes the logs of a run to the binary stream `out`, then keeps
+    writing what is appended to them while `is_running()`."""
+    log_path = osp.join(run_dir, LOG_FILE)
+    for path in segments(run_dir):
+        if path != log_path:
+            with open_segment(path) as f_seg:
+                shutil.copyfileobj(f_seg, out)
+    f_log = None
+    try:
+        while True:
+            if f_log is None and osp.exists(log_path):
+                f_log = open(log_path, 'rb')
+            if f_log is not None:
+                shutil.copyfileobj(f_log, out)
+                out.flush()
+                try:
+                    rotated = (os.stat(log_path).st_ino !=
+                               os.fstat(f_log.fileno()).st_ino)
+                except FileNotFoundError:
+                    rotated = True
+                if rotated:  # the rest was written before the rename
+                    shutil.copyfileobj(f_log, out)
+                    f_log.close()
+                    f_log = None
+                    continue
+            if not is_running():
+                break
+            time.sleep(interval)
+    finally:
+        if f_log is not None:
+            f_log.close()
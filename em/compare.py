@@ -0,0 +1,184 @@
+"""Comparing the sources and options of experiments."""
+import os
+import sys
+
+from em import db
+from em import sources
+from em import util
+
+E_DIFF_ONE = 'error: at least two experiments are needed for a diff'
+
+DIFF_NONE = 'The experiments have the same source and options.'
+DIFF_OPT = '  {}: {} -> {}'
+DIFF_SOURCE = 'source ({:d} versions):'
+DIFF_UNSET = '(unset)'
+
+
+def refresh_opts(emdb, names):
+    """Extracts the options of experiments whose `opts.pkl` was written
+    since it was last read into the options table."""
+    import pickle
+    cached = db.get_opts_stats(emdb)
+    changed = []
+    for name in names:
+        opts_path = util.expath(name, 'run', 'opts.pkl')
+        try:
+            fstat = os.stat(opts_path)
+        except FileNotFoundError:
+            continue
+        fstat = (fstat.st_ino, fstat.st_mtime_ns, fstat.st_size)
+        if cached.get(name) == fstat:
+            continue
+        try:
+            with open(opts_path, 'rb') as f_opts:
+                opts = vars(pickle.load(f_opts))
+        except Exception:  # pylint: disable=broad-except
+            opts = {}  # not retried until the file changes
+        changed.append((name, fstat, opts))
+    if changed:
+        with db.transaction(emdb):
+            for name, fstat, opts in changed:
+                db.set_opts(emdb, name, fstat, opts)
+
+
+def table(args, _config, _extra_args):
+    """Compare the options of experiments."""
+    from fnmatch import fnmatch
+    import json
+
+    keys = args.cols.split(',') if args.cols else None
+    with db.connect() as emdb:
+        all_names = db.names(emdb)
+        names = sorted(name for name in all_names
+                       if any(fnmatch(name, patt) for patt in args.name))
+        refresh_opts(emdb, names)
+        selected = names if len(names) < len(all_names) else None
+        if keys is None:
+            # options that are the same for all experiments are not shown
+            keys = (db.opts_keys(emdb, selected, varying=True) or
+                    db.opts_keys(emdb, selected))
+        exp_opts = db.get_opts(emdb, selected, keys)
+    names = [name for name in names if name in exp_opts]
+    if not names:
+        return
+
+    columns = {'name': names}
+    for key in keys:
+        columns[key] = [exp_opts[name].get(key) for name in names]
+    if args.format == 'json':
+        json.dump(columns, sys.stdout)
+        print()
+        return
+    rows = zip(*([_format_opt(val) for val in col]
+                 for col in columns.values()))
+    if args.format == 'table':
+        util.print_table([list(columns)] + [list(row) for row in rows])
+        return
+    import csv
+    writer = csv.writer(sys.stdout,
+                        delimiter='\t' if args.format == 'tsv' else ',')
+    writer.writerow(columns)
+    writer.writerows(rows)
+
+
+def _tree_ids(repo, emdb, names):
+    """Returns {name: source tree id} of the experiments that have one."""
+    tree_ids = {name: tree_id
+                for name, tree_id, _commit_id in db.all_snapshots(emdb)
+                if name in names}
+    for name in names:
+        if name not in tree_ids:  # archived or not indexed
+            exper_commit = sources.experiment_commit(repo, name)
+            if exper_commit is not None:
+                tree_ids[name] = str(exper_commit.tree_id)
+    return tree_ids
+
+
+def _print_pair_diff(repo, versions, files, keys, opt_vals, patch=False):
+    """Prints the differences of two experiments, one line each."""
+    # pylint: disable=too-many-arguments
+    if files:
+        print(DIFF_SOURCE.format(len(versions)))
+        for path, (entry_a, entry_b) in files:
+            status = ('A' if entry_a is None else
+                      'D' if entry_b is None else 'M')
+            print(f'  {status} {path}')
+        if patch:
+            print(repo.diff(repo[versions[0]], repo[versions[1]]).patch,
+                  end='')
+    if keys:
+        print('options:')
+        for key, vals in zip(keys, zip(*opt_vals.values())):
+            print(DIFF_OPT.format(key, *vals))
+
+
+def _print_diff_table(tree_ids, versions, files, keys, opt_vals):
+    """Prints the differences of many experiments as a table with a row per
+    experiment and a column per varying option."""
+    if files:
+        print(DIFF_SOURCE.format(len(versions)))
+        for path, _entries in files:
+            print(f'  {path}')
+        print()
+    rows = [['name'] + (['source'] if files else []) + keys]
+    for name, vals in opt_vals.items():
+        row = [name]
+        if files:
+            row.append(str(versions.index(tree_ids[name]) + 1)
+                       if name in tree_ids else DIFF_UNSET)
+        rows.append(row + vals)
+    util.print_table(rows)
+
+
+def diff(args, _config, _extra_args):
+    """Show how experiments differ in source and options."""
+    # pylint: disable=too-many-locals
+    from fnmatch import fnmatch
+    import pygit2
+    from em import snapshot
+    repo = pygit2.Repository('.')
+
+    with db.connect() as emdb:
+        all_names = sorted(db.names(emdb))
+        matched = {}  # ordered, so that `em diff a b` diffs a against b
+        for patt in args.name:
+            matches = [name for name in all_names if fnmatch(name, patt)]
+            if not matches:
+                return util.die(util.E_NO_EXP.format(patt))
+            matched.update(dict.fromkeys(matches))
+        names = list(matched)
+        if len(names) < 2:
+            return util.die(E_DIFF_ONE)
+        refresh_opts(emdb, names)
+        keys = db.opts_keys(emdb, names, varying=True)
+        exp_opts = db.get_opts(emdb, names, keys)
+        tree_ids = _tree_ids(repo, emdb, matched)
+    if len(names) == 2 and len(tree_ids) < 2:
+        return util.die(util.E_NO_BRANCH.format(
+            next(name for name in names if name not in tree_ids)))
+
+    # sweeps mostly share their source, so only distinct trees are compared
+    versions = list(dict.fromkeys(tree_ids[name] for name in names
+                                  if name in tree_ids))
+    files = []
+    if len(versions) > 1:
+        files = snapshot.varying_entries(
+            repo, [repo[tree_id] for tree_id in versions])
+    if not files and not keys:
+        print(DIFF_NONE)
+        return None
+
+    opt_vals = {name: [_format_opt(exp_opts.get(name, {}).get(key, DIFF_UNSET))
+                       for key in keys] for name in names}
+    if len(names) == 2:
+        _print_pair_diff(repo, versions, files, keys, opt_vals, args.patch)
+    else:
+        _print_diff_table(tree_ids, versions, files, keys, opt_vals)
+    return None
+
+
+def _format_opt(val):
+    import json
+    if val is None:
+        return ''
+    return val if isinstance(val, str) else json.dumps(val)
@@ -0,0 +1,152 @@
+"""A control channel between `em ctl` and the job of an experiment.
+
+The job listens on a Unix socket in its run directory and handles the
+commands sent to it between training steps:
+
+    from em import control
+
+    channel = control.Channel()
+    ...
+    for cmd in channel.poll():
+        if cmd.args == ['save']:
+            save_checkpoint()
+            cmd.reply({'epoch': epoch})
+
+Commands are queued in the order they arrive. The sender is acknowledged
+once a command is queued and again with the job's reply. Messages are
+newline-delimited JSON.
+"""
+import atexit
+import json
+import os
+from os import path as osp
+import queue
+import socket
+import threading
+
+SOCKET_FILE = 'ctl.sock'
+
+REPLY_TIMEOUT = 30  # seconds
+
+E_JOB_EXITED = 'the job exited before handling the command'
+
+
+def _send_msg(f_sock, msg):
+    f_sock.write(json.dumps(msg) + '\n')
+    f_sock.flush()
+
+
+class Command:
+    """A command sent to a job. `args` is the list of its words."""
+
+    def __init__(self, args):
+        self.args = args
+        self.result = None
+        self.done = threading.Event()
+
+    def reply(self, payload=None, ok=True):
+        """Answers the sender with a JSON-serializable payload."""
+        self.result = {'ok': ok, 'reply': payload}
+        self.done.set()
+
+
+class Channel:
+    """Receives commands for the job running in `run_dir`."""
+
+    def __init__(self, run_dir='run'):
+        os.makedirs(run_dir, exist_ok=True)
+        self.path = osp.join(run_dir, SOCKET_FILE)
+        self._cmds = queue.Queue()
+        if osp.exists(self.path):  # left by an earlier run
+            os.remove(self.path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(self.path)
+        self._sock.listen()
+        threading.Thread(target=self._accept, daemon=True).start()
+        atexit.register(self.close)
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _addr = self._sock.accept()
+            except OSError:
+                return  # closed
+            threading.Thread(target=self._serve, args=(conn,),
+                             daemon=True).start()
+
+    def _serve(self, conn):
+        with conn, conn.makefile('rw') as f_conn:
+            try:
+                for line in f_conn:
+                    try:
+                        cmd = Command(list(json.loads(line)['cmd']))
+                    except (ValueError, KeyError, TypeError) as err:
+                        _send_msg(f_conn, {'ok': False, 'reply': str(err)})
+                        continue
+                    self._cmds.put(cmd)
+                    _send_msg(f_conn, {'queued': True})
+                    cmd.done.wait()
+                    _send_msg(f_conn, cmd.result)
+            except OSError:
+                pass  # the sender gave up
+
+    def poll(self, timeout=0):
+        """Returns the commands received since the last poll, oldest first.
+
+        Waits up to `timeout` seconds for a command if there are none."""
+        cmds = []
+        try:
+            cmds.append(self._cmds.get(timeout=timeout) if timeout else
+                        self._cmds.get_nowait())
+            while True:
+                cmds.append(self._cmds.get_nowait())
+        except queue.Empty:
+            pass
+        return cmds
+
+    def handle(self, handler, timeout=0):
+        """Replies to each received command with `handler(*cmd.args)`."""
+        for cmd in self.poll(timeout):
+            try:
+                cmd.reply(handler(*cmd.args))
+            except Exception as err:  # pylint: disable=broad-except
+                cmd.reply(str(err), ok=False)
+
+    def close(self):
+        """Stops listening and fails the commands that were not handled."""
+        if self._sock is None:
+            return
+        self._sock.close()
+        self._sock = None
+        if osp.exists(self.path):
+            os.remove(self.path)
+        for cmd in self.poll():
+            cmd.reply(E_JOB_EXITED, ok=False)
+        atexit.unregister(self.close)
+
+
+def send(run_dir, args, timeout=REPLY_TIMEOUT):
+    """Sends a command to the job running in `run_dir` and returns its
+    {'ok': bool, 'reply': payload} answer.
+
+    Returns None if the job has no control channel. Raises TimeoutError if
+    the job does not answer within `timeout` seconds."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(osp.relpath(osp.join(run_dir, SOCKET_FILE)))
+    except (FileNotFoundError, ConnectionRefusedError):
+        sock.close()
+        return None
+    sock.settimeout(timeout)
+    with sock, sock.makefile('rw') as f_sock:
+        try:
+            _send_msg(f_sock, {'cmd': list(args)})
+            ack = json.loads(f_sock.readline() or 'null')
+            if not ack or not ack.get('queued'):
+                return ack
+            reply = f_sock.readline()
+        except socket.timeout:
+            raise TimeoutError from None
+    if not reply:
+        return {'ok': False, 'reply': E_JOB_EXITED}
+    return json.loads(reply)
@@ -0,0 +1,676 @@
+"""SQLite-backed experiment metadata store.
+
+Each experiment is a row of the ``experiments`` table with one column per
+well-known field; any other fields are kept as JSON in the ``extra`` column.
+The database runs in WAL mode so that concurrent readers never block and
+background jobs can record status changes without clobbering one another.
+On network filesystems, whose hosts cannot share WAL's memory-mapped index,
+it falls back to a rollback journal.
+"""
+import contextlib
+import datetime
+import functools
+import json
+from os import path as osp
+import sqlite3
+import time
+
+DB_FILE = '.em.sqlite'
+LEGACY_DB_FILE = '.em'
+LEGACY_EM_KEY = '__em__'
+# the meta key set once a legacy database has been migrated (or found absent)
+LEGACY_MIGRATED_KEY = 'legacy_migrated'
+
+BUSY_TIMEOUT = 30  # seconds
+
+# filesystems that may be mounted by several hosts at once
+NETWORK_FS = ('nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'afs', '9p', 'lustre',
+              'gpfs', 'ceph', 'glusterfs', 'beegfs', 'fuse.sshfs')
+
+TIME_FIELDS = ('created', 'started', 'ended', 'queued', 'heartbeat',
+               'archived')
+FIELDS = ('status', 'pid', 'hostname', 'gpu', 'clone_of', 'desc',
+          'returncode', 'priority', 'queue_seq', 'nslots',
+          'slots') + TIME_FIELDS
+
+# operators of query conditions; the value of `in` is a sequence
+QUERY_OPS = ('=', '!=', '<', '<=', '>', '>=', 'in')
+
+# fields of metric summaries (see `em.metrics.SUMMARY_FIELDS`)
+METRIC_AGGS = ('count', 'min', 'min_step', 'max', 'max_step', 'last',
+               'last_step', 'epochs', 'last_epoch')
+
+_SUMMARY_TABLES = ('metric_summaries', 'metrics_offsets')
+
+# each entry migrates the schema from version `i` to `i + 1`
+_MIGRATIONS = [
+    [
+        'CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)',
+        '''CREATE TABLE experiments (
+            name TEXT PRIMARY KEY,
+            status TEXT,
+            created REAL,
+            started REAL,
+            ended REAL,
+            pid INTEGER,
+            hostname TEXT,
+            gpu TEXT,
+            clone_of TEXT,
+            desc TEXT,
+            returncode INTEGER,
+            extra TEXT
+        )''',
+        'CREATE INDEX experiments_status ON experiments (status)',
+        'CREATE INDEX experiments_started ON experiments (started)',
+        'CREATE INDEX experiments_hostname ON experiments (hostname)',
+    ],
+    [
+        '''CREATE TABLE snapshots (
+            name TEXT PRIMARY KEY,
+            tree_id TEXT NOT NULL,
+            commit_id TEXT NOT NULL
+        )''',
+        'CREATE INDEX snapshots_tree_id ON snapshots (tree_id)',
+    ],
+    [
+        '''CREATE TABLE stat_cache (
+            root TEXT NOT NULL,
+            path TEXT NOT NULL,
+            ino INTEGER,
+            mtime_ns INTEGER,
+            size INTEGER,
+            oid TEXT,
+            PRIMARY KEY (root, path)
+        )''',
+    ],
+    [
+        'ALTER TABLE experiments ADD COLUMN queued REAL',
+        'ALTER TABLE experiments ADD COLUMN priority INTEGER',
+        'ALTER TABLE experiments ADD COLUMN queue_seq INTEGER',
+        'ALTER TABLE experiments ADD COLUMN nslots INTEGER',
+        'ALTER TABLE experiments ADD COLUMN slots TEXT',
+    ],
+    [
+        'ALTER TABLE experiments ADD COLUMN heartbeat REAL',
+    ],
+    [
+        'ALTER TABLE experiments ADD COLUMN archived REAL',
+    ],
+    [
+        '''CREATE TABLE opts_files (
+            name TEXT PRIMARY KEY,
+            ino INTEGER,
+            mtime_ns INTEGER,
+            size INTEGER
+        )''',
+        '''CREATE TABLE opts (
+            name TEXT NOT NULL,
+            key TEXT NOT NULL,
+            value TEXT,
+            PRIMARY KEY (name, key)
+        )''',
+        'CREATE INDEX opts_key ON opts (key, value)',
+    ],
+    [
+        '''CREATE TABLE metric_summaries (
+            name TEXT NOT NULL,
+            metric TEXT NOT NULL,
+            count INTEGER,
+            min REAL,
+            min_step INTEGER,
+            max REAL,
+            max_step INTEGER,
+            last REAL,
+            last_step INTEGER,
+            epochs INTEGER,
+            last_epoch INTEGER,
+            PRIMARY KEY (name, metric)
+        )''',
+        'CREATE INDEX metric_summaries_metric ON metric_summaries (metric)',
+        # `log_ino` and `log_offset` locate where in run/log.txt the
+        # summaries of its stats were computed to
+        '''CREATE TABLE metrics_offsets (
+            name TEXT PRIMARY KEY,
+            ino INTEGER,
+            nrecords INTEGER,
+            log_ino INTEGER,
+            log_offset INTEGER
+        )''',
+    ],
+]
+
+
+def _db_path(proj_dir):
+    return osp.join(proj_dir, DB_FILE)
+
+
+def _has_legacy_db(proj_dir):
+    import dbm
+    return bool(dbm.whichdb(osp.join(proj_dir, LEGACY_DB_FILE)))
+
+
+def is_project(proj_dir='.'):
+    """Returns whether `proj_dir` is an em project."""
+    if osp.isfile(_db_path(proj_dir)):
+        return True
+    if not _has_legacy_db(proj_dir):
+        return False
+    import shelve
+    with shelve.open(osp.join(proj_dir, LEGACY_DB_FILE), 'r') as legacy_db:
+        return LEGACY_EM_KEY in legacy_db
+
+
+@functools.lru_cache()
+def _is_network_fs(dir_path):
+    """Returns whether `dir_path` is on a network filesystem, as far as the
+    mount table of this (Linux) host tells."""
+    fstype, mount_len = None, -1
+    try:
+        with open('/proc/self/mounts') as f_mounts:
+            for line in f_mounts:
+                _dev, mount_point, mount_fstype = line.split()[:3]
+                mount_point = mount_point.replace('\\040', ' ')
+                is_inside = (dir_path + '/').startswith(
+                    mount_point.rstrip('/') + '/')
+                if is_inside and len(mount_point) > mount_len:
+                    fstype, mount_len = mount_fstype, len(mount_point)
+    except OSError:
+        return False
+    return fstype in NETWORK_FS
+
+
+def _connect(db_path):
+    conn = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT,
+                           isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    if _is_network_fs(osp.dirname(osp.realpath(db_path))):
+        conn.execute('PRAGMA journal_mode=DELETE')
+    else:
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+
+@contextlib.contextmanager
+def transaction(conn):
+    """Runs the enclosed statements in a single write transaction."""
+    if conn.in_transaction:  # nested; the outer transaction commits
+        yield conn
+        return
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield conn
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
+
+
+def _upgrade(conn):
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    if version >= len(_MIGRATIONS):
+        return
+    with transaction(conn):
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        for migration in _MIGRATIONS[version:]:
+            for stmt in migration:
+                conn.execute(stmt)
+        conn.execute(f'PRAGMA user_version = {len(_MIGRATIONS):d}')
+
+
+def _to_db(field, val):
+    if field in TIME_FIELDS and isinstance(val, datetime.datetime):
+        return val.timestamp()
+    return val
+
+
+def _from_db(field, val):
+    if field in TIME_FIELDS and val is not None:
+        return datetime.datetime.fromtimestamp(val)
+    return val
+
+
+def _jsonable(val):
+    if isinstance(val, datetime.datetime):
+        return val.isoformat()
+    return val
+
+
+def _row_to_info(row):
+    info = {field: _from_db(field, row[field])
+            for field in FIELDS if row[field] is not None}
+    if row['extra']:
+        info.update(json.loads(row['extra']))
+    return info
+
+
+def _split_info(info):
+    cols = {}
+    extra = {}
+    for field, val in info.items():
+        if field in FIELDS:
+            cols[field] = _to_db(field, val)
+        elif val is not None:
+            extra[field] = _jsonable(val)
+    return cols, extra
+
+
+def _migrate_legacy(conn, proj_dir):
+    import shelve
+    with transaction(conn):
+        if get_meta(conn, LEGACY_MIGRATED_KEY):
+            return  # another process got here first
+        if _has_legacy_db(proj_dir):
+            with shelve.open(osp.join(proj_dir, LEGACY_DB_FILE),
+                             'r') as legacy:
+                for name, info in legacy.items():
+                    if name == LEGACY_EM_KEY:
+                        set_meta(conn, 'em', info)
+                    else:
+                        put(conn, name, info)
+        # set in the same transaction, so a crashed migration is retried
+        set_meta(conn, LEGACY_MIGRATED_KEY, True)
+
+
+@contextlib.contextmanager
+def connect(proj_dir='.'):
+    """Opens the metadata store of the project in `proj_dir`.
+
+    A legacy `.em` shelve database is migrated on first use."""
+    conn = _connect(_db_path(proj_dir))
+    try:
+        _upgrade(conn)
+        if not get_meta(conn, LEGACY_MIGRATED_KEY):
+            _migrate_legacy(conn, proj_dir)
+        yield conn
+    finally:
+        conn.close()
+
+
+def create_project(proj_dir):
+    """Initializes the metadata store for a new project."""
+    with connect(proj_dir) as conn:
+        if get_meta(conn, 'em') is None:
+            set_meta(conn, 'em', {})
+
+
+def get_meta(conn, key, default=None):
+    """Returns a JSON-valued project setting."""
+    row = conn.execute('SELECT value FROM meta WHERE key = ?',
+                       (key,)).fetchone()
+    return json.loads(row['value']) if row else default
+
+
+def set_meta(conn, key, value):
+    """Stores a JSON-valued project setting."""
+    conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                 (key, json.dumps(value)))
+
+
+def get(conn, name):
+    """Returns the info dict of an experiment or None."""
+    row = conn.execute('SELECT * FROM experiments WHERE name = ?',
+                       (name,)).fetchone()
+    return _row_to_info(row) if row else None
+
+
+def names(conn):
+    """Returns the set of experiment names."""
+    return {row[0] for row in conn.execute('SELECT name FROM experiments')}
+
+
+def metric_field(field):
+    """Returns the (metric, aggregate) of a metric summary field, written
+    like `val:loss:min` for the min of `val/loss`, or None."""
+    *parts, agg = field.split(':')
+    if not parts:
+        return None
+    if agg not in METRIC_AGGS or not all(parts):
+        raise ValueError(f'invalid metric field: {field}')
+    return '/'.join(parts), agg
+
+
+def _field_sql(field, params, now):
+    metric = metric_field(field)
+    if metric is not None:
+        params.append(metric[0])
+        return (f'(SELECT {metric[1]} FROM metric_summaries AS s '
+                'WHERE s.name = experiments.name AND s.metric = ?)')
+    if not field.isidentifier():
+        raise ValueError(f'invalid field name: {field}')
+    if field == 'name' or field in FIELDS:
+        return field
+    if field == 'duration':  # seconds until the end or now, if running
+        params.append(now)
+        return '(COALESCE(ended, ?) - started)'
+    params.append(f'$."{field}"')
+    return 'json_extract(extra, ?)'
+
+
+def query(conn, conditions=(), fields=None, sort='name', reverse=False,
+          limit=None):
+    """Returns (name, info) pairs of the experiments meeting all conditions.
+
+    Conditions are (field, op, value) triples with an op in QUERY_OPS. Any
+    field may be used, including extra fields, `duration`, the number of
+    seconds a job ran (or has been running), and metric summaries (see
+    `metric_field`). If `fields` is given, info only holds those fields. At
+    most `limit` experiments are returned. The whole query runs in SQLite,
+    so conditions on indexed fields need not visit every experiment."""
+    # pylint: disable=too-many-arguments,too-many-locals
+    now = time.time()
+    params = []
+    if fields is None:
+        select = '*'
+    else:
+        select = ', '.join(['name'] + [
+            f'{_field_sql(field, params, now)} AS "{field}"'
+            for field in fields])
+    where = []
+    for field, op, val in conditions:
+        if op not in QUERY_OPS:
+            raise ValueError(f'unknown operator: {op}')
+        field_sql = _field_sql(field, params, now)
+        if op == 'in':
+            val = list(val)
+            where.append(f'{field_sql} IN ({", ".join("?" * len(val))})')
+            params.extend(_to_db(field, v) for v in val)
+        else:
+            where.append(f'{field_sql} {op} ?')
+            params.append(_to_db(field, val))
+    order = _field_sql(sort, params, now) + (' DESC' if reverse else '')
+    if metric_field(sort) is not None:  # experiments without it go last
+        order = f'{_field_sql(sort, params, now)} IS NULL, {order}'
+    if limit is not None:
+        order += ' LIMIT ?'
+        params.append(limit)
+    rows = conn.execute(
+        f'SELECT {select} FROM experiments '
+        f'WHERE {" AND ".join(where) or "1"} ORDER BY {order}', params)
+    if fields is None:
+        return [(row['name'], _row_to_info(row)) for row in rows]
+    return [(row['name'], {field: _from_db(field, row[field])
+                           for field in fields if row[field] is not None})
+            for row in rows]
+
+
+def items(conn):
+    """Returns a list of (name, info) pairs for all experiments."""
+    return [(row['name'], _row_to_info(row))
+            for row in conn.execute('SELECT * FROM experiments')]
+
+
+def put(conn, name, info):
+    """Replaces the info of an experiment."""
+    cols, extra = _split_info(info)
+    cols['name'] = name
+    cols['extra'] = json.dumps(extra) if extra else None
+    conn.execute(
+        f'INSERT OR REPLACE INTO experiments ({", ".join(cols)}) '
+        f'VALUES ({", ".join("?" * len(cols))})', list(cols.values()))
+
+
+def insert(conn, name, info):
+    """Adds a new experiment. Returns False if it already exists."""
+    cols, extra = _split_info(info)
+    cols['name'] = name
+    cols['extra'] = json.dumps(extra) if extra else None
+    try:
+        conn.execute(
+            f'INSERT INTO experiments ({", ".join(cols)}) '
+            f'VALUES ({", ".join("?" * len(cols))})', list(cols.values()))
+    except sqlite3.IntegrityError:
+        return False
+    return True
+
+
+def _update_where(conn, name, fields, where='', params=()):
+    cols, extra = _split_info(fields)
+    cleared = [field for field, val in fields.items()
+               if field not in FIELDS and val is None]
+    with transaction(conn):
+        if extra or cleared:
+            row = conn.execute('SELECT extra FROM experiments WHERE name = ?',
+                               (name,)).fetchone()
+            if row is None:
+                return False
+            merged = json.loads(row['extra'] or '{}')
+            merged.update(extra)
+            for field in cleared:
+                merged.pop(field, None)
+            cols['extra'] = json.dumps(merged) if merged else None
+        if not cols:
+            return get(conn, name) is not None
+        assignments = ', '.join(f'{col} = ?' for col in cols)
+        cur = conn.execute(
+            f'UPDATE experiments SET {assignments} WHERE name = ?{where}',
+            list(cols.values()) + [name] + list(params))
+        return cur.rowcount > 0
+
+
+def update(conn, name, **fields):
+    """Sets fields of an experiment. Fields set to None are removed."""
+    return _update_where(conn, name, fields)
+
+
+def transition(conn, name, status, from_status=None, **fields):
+    """Atomically moves an experiment into `status`, optionally only if it
+    is currently in (one of) `from_status`. Returns whether it moved."""
+    fields['status'] = status
+    if from_status is None:
+        return _update_where(conn, name, fields)
+    if isinstance(from_status, str):
+        from_status = (from_status,)
+    marks = ', '.join('?' * len(from_status))
+    return _update_where(conn, name, fields,
+                         f' AND status IN ({marks})', from_status)
+
+
+def exit_status(returncode):
+    """Returns the experiment status for a job exit code."""
+    if returncode == 0:
+        return 'completed'
+    if returncode in (-2, 130):  # SIGINT
+        return 'interrupted'
+    return 'error'
+
+
+def job_started(conn, name, pid, hostname, gpu=None):
+    """Records the start of an experiment's job."""
+    now = datetime.datetime.now()
+    return transition(conn, name, 'running',
+                      started=now,
+                      heartbeat=now,
+                      pid=pid,
+                      hostname=hostname,
+                      gpu=gpu,
+                      ended=None,
+                      returncode=None)
+
+
+def job_ended(conn, name, status=None, returncode=None):
+    """Records the exit of an experiment's job. The status is only updated
+    if the experiment was not reset while it ran."""
+    with transaction(conn):
+        if status:
+            transition(conn, name, status, from_status='running')
+        update(conn, name, pid=None, ended=datetime.datetime.now(),
+               returncode=returncode, heartbeat=None)
+
+
+def delete(conn, name):
+    """Removes an experiment."""
+    with transaction(conn):
+        for table in ('experiments', 'snapshots', 'opts_files',
+                      'opts') + _SUMMARY_TABLES:
+            conn.execute(f'DELETE FROM {table} WHERE name = ?', (name,))
+
+
+def rename(conn, name, new_name):
+    """Renames an experiment."""
+    with transaction(conn):
+        for table in ('experiments', 'snapshots', 'opts_files',
+                      'opts') + _SUMMARY_TABLES:
+            conn.execute(f'UPDATE {table} SET name = ? WHERE name = ?',
+                         (new_name, name))
+
+
+def all_snapshots(conn):
+    """Returns (name, tree_id, commit_id) triples of all indexed snapshots."""
+    return [tuple(row) for row in conn.execute(
+        'SELECT name, tree_id, commit_id FROM snapshots')]
+
+
+def add_snapshot(conn, name, tree_id, commit_id):
+    """Records the source snapshot commit of an experiment."""
+    conn.execute('INSERT OR REPLACE INTO snapshots (name, tree_id, commit_id) '
+                 'VALUES (?, ?, ?)', (name, str(tree_id), str(commit_id)))
+
+
+def remove_snapshot(conn, name):
+    """Forgets the source snapshot commit of an experiment."""
+    conn.execute('DELETE FROM snapshots WHERE name = ?', (name,))
+
+
+def find_snapshots(conn, tree_id):
+    """Returns (name, commit_id) pairs of snapshots of the tree `tree_id`.
+
+    Returns None if the snapshot index has not been built."""
+    if not get_meta(conn, 'snapshots_indexed'):
+        return None
+    return [(row['name'], row['commit_id']) for row in conn.execute(
+        'SELECT name, commit_id FROM snapshots WHERE tree_id = ?',
+        (str(tree_id),))]
+
+
+def reindex_snapshots(conn, snapshots):
+    """Replaces the snapshot index with (name, tree_id, commit_id) triples."""
+    with transaction(conn):
+        conn.execute('DELETE FROM snapshots')
+        for name, tree_id, commit_id in snapshots:
+            add_snapshot(conn, name, tree_id, commit_id)
+        set_meta(conn, 'snapshots_indexed', True)
+
+
+def get_opts_stats(conn):
+    """Returns {name: (ino, mtime_ns, size)} of the options files from
+    which the options table was extracted."""
+    return {row[0]: tuple(row[1:]) for row in conn.execute(
+        'SELECT name, ino, mtime_ns, size FROM opts_files')}
+
+
+def set_opts(conn, name, fstat, opts):
+    """Replaces the options of an experiment, extracted from an options
+    file with stats `fstat` (ino, mtime_ns, size)."""
+    with transaction(conn):
+        conn.execute('DELETE FROM opts WHERE name = ?', (name,))
+        conn.executemany(
+            'INSERT INTO opts (name, key, value) VALUES (?, ?, ?)',
+            [(name, key, json.dumps(val, default=repr))
+             for key, val in opts.items()])
+        conn.execute(
+            'INSERT OR REPLACE INTO opts_files (name, ino, mtime_ns, size) '
+            'VALUES (?, ?, ?, ?)', (name,) + tuple(fstat))
+
+
+def _opts_where(exp_names, keys):
+    conds = []
+    params = []
+    for field, vals in (('name', exp_names), ('key', keys)):
+        if vals is not None:
+            vals = list(vals)
+            conds.append(f'{field} IN ({", ".join("?" * len(vals))})')
+            params += vals
+    return (f' WHERE {" AND ".join(conds)}' if conds else ''), params
+
+
+def opts_keys(conn, exp_names=None, varying=False):
+    """Returns the sorted option keys of the named experiments (or all).
+
+    If `varying`, only keys whose values differ between the experiments or
+    that some of them lack are returned."""
+    where, params = _opts_where(exp_names, None)
+    if not varying:
+        return [row[0] for row in conn.execute(
+            f'SELECT DISTINCT key FROM opts{where} ORDER BY key', params)]
+    nexps = conn.execute(f'SELECT COUNT(DISTINCT name) FROM opts{where}',
+                         params).fetchone()[0]
+    return [row[0] for row in conn.execute(
+        f'SELECT key FROM opts{where} GROUP BY key '
+        'HAVING COUNT(DISTINCT value) > 1 OR COUNT(*) < ? ORDER BY key',
+        params + [nexps])]
+
+
+def get_opts(conn, exp_names=None, keys=None):
+    """Returns {name: {key: value}} of the options of the named experiments
+    (or all), restricted to `keys` if given."""
+    where, params = _opts_where(exp_names, keys)
+    opts = {}
+    for name, key, value in conn.execute(
+            f'SELECT name, key, value FROM opts{where}', params):
+        opts.setdefault(name, {})[key] = json.loads(value)
+    return opts
+
+
+def get_metrics_offset(conn, name):
+    """Returns the (ino, record index) of the metrics file and the (ino, byte
+    offset) of the log of an experiment up to which its metric summaries were
+    computed, as one tuple, or None."""
+    row = conn.execute('SELECT ino, nrecords, log_ino, log_offset '
+                       'FROM metrics_offsets WHERE name = ?',
+                       (name,)).fetchone()
+    return tuple(row) if row else None
+
+
+def get_metric_summaries(conn, name):
+    """Returns {metric: {aggregate: value}} of an experiment."""
+    return {row['metric']: {agg: row[agg] for agg in METRIC_AGGS}
+            for row in conn.execute(
+                'SELECT * FROM metric_summaries WHERE name = ?', (name,))}
+
+
+def set_metric_summaries(conn, name, summaries, offsets):
+    """Replaces the metric summaries of an experiment, computed up to
+    `offsets` (see `get_metrics_offset`)."""
+    with transaction(conn):
+        conn.execute('DELETE FROM metric_summaries WHERE name = ?', (name,))
+        conn.executemany(
+            f'INSERT INTO metric_summaries (name, metric, '
+            f'{", ".join(METRIC_AGGS)}) '
+            f'VALUES ({", ".join("?" * (len(METRIC_AGGS) + 2))})',
+            [[name, metric] + [summary[agg] for agg in METRIC_AGGS]
+             for metric, summary in summaries.items()])
+        conn.execute('INSERT OR REPLACE INTO metrics_offsets '
+                     '(name, ino, nrecords, log_ino, log_offset) '
+                     'VALUES (?, ?, ?, ?, ?)', (name,) + tuple(offsets))
+
+
+def get_stat_cache(conn, root, path=None):
+    """Returns {path: (ino, mtime_ns, size, oid)} of files under `root`, or
+    the entry of `path` (or None) if it is given."""
+    if path is not None:
+        row = conn.execute(
+            'SELECT ino, mtime_ns, size, oid FROM stat_cache '
+            'WHERE root = ? AND path = ?', (root, path)).fetchone()
+        return tuple(row) if row else None
+    return {row[0]: tuple(row[1:]) for row in conn.execute(
+        'SELECT path, ino, mtime_ns, size, oid FROM stat_cache '
+        'WHERE root = ?', (root,))}
+
+
+def update_stat_cache(conn, root, entries):
+    """Adds or replaces cached file stats under `root`."""
+    conn.executemany(
+        'INSERT OR REPLACE INTO stat_cache '
+        '(root, path, ino, mtime_ns, size, oid) VALUES (?, ?, ?, ?, ?, ?)',
+        [(root, path) + entry for path, entry in entries.items()])
+
+
+def set_stat_cache(conn, root, entries):
+    """Replaces the cached file stats of `root`."""
+    with transaction(conn):
+        conn.execute('DELETE FROM stat_cache WHERE root = ?', (root,))
+        conn.executemany(
+            'INSERT INTO stat_cache (root, path, ino, mtime_ns, size, oid) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            [(root, path) + entry for path, entry in entries.items()])
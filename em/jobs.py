@@ -0,0 +1,196 @@
+"""Running the jobs of experiments."""
+import os
+import sys
+
+from em import db
+from em import sched
+from em import util
+
+E_SUPERVISOR = 'error: supervisor: {}'
+
+
+def _ingest_snaps(name):
+    """Moves the finished checkpoints of an experiment into the store."""
+    from em import store
+    with db.connect() as emdb:
+        store.ingest(emdb, store.store_path(),
+                     util.expath(name, 'run', 'snaps'), min_age=0)
+
+
+def _unshare_snaps(name, mode='auto'):
+    """Gives an experiment private copies of the stored checkpoints that its
+    job may rewrite."""
+    from em import store
+    with db.connect() as emdb:
+        store.unshare(emdb, util.expath(name, 'run', 'snaps'), mode)
+
+
+def _update_summaries(name, log_stats=()):
+    """Folds the metrics an experiment wrote since the last update into its
+    metric summaries."""
+    from em import metrics
+    with db.connect() as emdb:
+        metrics.update_summaries(emdb, name, util.expath(name, 'run'),
+                                 log_stats)
+
+
+def _job_env(gpu=None, cpus=None, background=False):
+    """Returns the environment of a job."""
+    env = os.environ
+    if gpu:
+        env['CUDA_VISIBLE_DEVICES'] = gpu
+    if background:  # the log is a pipe, which Python would block-buffer
+        env.setdefault('PYTHONUNBUFFERED', '1')
+    if cpus:
+        env['OMP_NUM_THREADS'] = str(len(cpus))
+    return env
+
+
+def _start_job(cmd, cwd, env, cpus=None, run_dir=None):
+    """Starts a job on the terminal or, if `run_dir` is given, with its
+    output captured into the logs of `run_dir`. Returns (job, capture)."""
+    import subprocess
+    from em import capture
+
+    if run_dir is None:
+        return subprocess.Popen(cmd, cwd=cwd, env=env, stdin=sys.stdin,
+                                stdout=sys.stdout, stderr=sys.stderr,
+                                preexec_fn=sched.pin_cpus(cpus)), None
+    read_fd, write_fd = os.pipe()
+    job_log = capture.Capture(read_fd, run_dir)
+    with os.fdopen(write_fd, 'wb') as f_out:
+        return subprocess.Popen(cmd, cwd=cwd, env=env, stdin=sys.stdin,
+                                stdout=f_out, stderr=f_out,
+                                preexec_fn=sched.pin_cpus(cpus)), job_log
+
+
+def _run_attached(name, cmd, env, gpu=None, cpus=None, sample_secs=0,
+                  log_stats=(), background=False):
+    """Runs a job in this process and records its lifecycle."""
+    # pylint: disable=too-many-arguments
+    import socket
+
+    job = job_log = status = returncode = None
+    try:
+        job, job_log = _start_job(
+            cmd, util.expath(name), env, cpus,
+            util.expath(name, 'run') if background else None)
+        with db.connect() as emdb:
+            db.job_started(emdb, name, job.pid, socket.getfqdn(), gpu)
+        returncode = _wait_job(name, job, sample_secs, log_stats)
+        status = db.exit_status(returncode)
+    except KeyboardInterrupt:
+        status = 'interrupted'
+        # the job got the SIGINT too; its checkpoints and output are
+        # complete only once it has exited
+        while job is not None and returncode is None:
+            try:
+                returncode = job.wait()
+            except KeyboardInterrupt:
+                pass
+    finally:
+        if job_log is not None:
+            job_log.join()
+        with db.connect() as emdb:
+            db.job_ended(emdb, name, status, returncode)
+        _ingest_snaps(name)
+        _update_summaries(name, log_stats)
+
+
+def run_job(name, config, gpu=None, prog_args=None, background=False,
+            cpus=None):
+    """Runs the program of an experiment, in the background through the
+    supervisor or a daemon if `background` is set. Either way, this process
+    is not detached.
+
+    Background jobs write their output to `run/stdout.log`; foreground jobs
+    keep the terminal, so their output is neither buffered nor logged."""
+    # pylint: disable=too-many-arguments
+    from em import metrics
+
+    sample_secs = config['experiment']['sample_secs']
+    log_stats = metrics.log_stats(config)
+    runem_cmd = ([config['experiment']['prog']] +
+                 config['experiment']['prog_args'] +
+                 (prog_args or []))
+    env = _job_env(gpu, cpus, background)
+
+    _unshare_snaps(name, config['experiment']['unshare_snaps'])
+
+    if not background:
+        _run_attached(name, runem_cmd, env, gpu, cpus, sample_secs, log_stats)
+        return None
+    status = _supervise(name, runem_cmd, util.expath(name), env, gpu, cpus,
+                        sample_secs, log_stats)
+    if status is not None:
+        return status
+    util.spawn_daemon(_run_attached, name, runem_cmd, env, gpu, cpus,
+                      sample_secs, log_stats, background=True)
+    return None
+
+
+def _wait_job(name, job, sample_secs=0, log_stats=()):
+    """Waits for a job to exit while recording its heartbeat and, every
+    `sample_secs`, its resource usage. Returns its exit code."""
+    import subprocess
+    import time
+    from em import resources
+
+    sampler = None
+    interval = sched.HEARTBEAT_SECS
+    if sample_secs:
+        sampler = resources.Sampler(job.pid, util.expath(name, 'run'))
+        sampler.sample()
+        interval = min(sample_secs, interval)
+    next_beat = time.monotonic() + sched.HEARTBEAT_SECS
+    while True:
+        try:
+            return job.wait(timeout=interval)
+        except subprocess.TimeoutExpired:
+            pass
+        if sampler is not None:
+            sampler.sample()
+        if time.monotonic() >= next_beat:
+            sched.beat(util.expath(name, 'run'), job.pid)
+            _update_summaries(name, log_stats)
+            next_beat += sched.HEARTBEAT_SECS
+
+
+def _supervise(name, cmd, cwd, env, gpu=None, cpus=None, sample_secs=0,
+               log_stats=()):
+    """Hands a job to the project's supervisor. Returns the exit status of
+    the command, or None if there is no supervisor to take the job.
+
+    A supervisor that fails the request, or does not reply to it, is
+    reported rather than replaced, since it may have started the job."""
+    # pylint: disable=too-many-arguments
+    from em import supervisor
+    reply = supervisor.request({
+        'op': 'launch',
+        'name': name,
+        'cmd': cmd,
+        'cwd': cwd,
+        'env': dict(env),
+        'gpu': gpu,
+        'cpus': sorted(cpus) if cpus else None,
+        'sample_secs': sample_secs,
+        'log_stats': list(log_stats),
+    })
+    if reply is None:
+        return None
+    if not reply['ok']:
+        with db.connect() as emdb:  # the job will never start
+            db.transition(emdb, name, 'error', from_status='starting')
+        return util.die(E_SUPERVISOR.format(reply['error']))
+    return 0
+
+
+def launch_queued(launches, kind, config):
+    """Spawns the jobs `sched` assigned to free slots of kind `kind`."""
+    for name, slots, prog_args in launches:
+        if kind == 'cpu':
+            run_job(name, config, prog_args=prog_args, background=True,
+                    cpus={int(slot) for slot in slots})
+        else:
+            run_job(name, config, gpu=','.join(slots), prog_args=prog_args,
+                    background=True)
@@ -0,0 +1,144 @@
+"""Incremental parsing of the stats that programs print to `run/log.txt`.
+
+Stats are lines like `[<epoch>] (<itr>/<itr_per_epoch>) | ... loss: 0.5`
+(or `[<epoch>] (VAL) | ...` for validation). The values parsed from a log
+are cached next to it in a `.npz` file, with the byte offset up to which it
+was parsed, so later reads only parse newly appended lines. This is shared
+by `em.plot_loss` and the log summaries of `em.metrics`.
+"""
+import hashlib
+import mmap
+import os
+import re
+
+import numpy as np
+
+# bytes at the start of the log used to tell if it was replaced
+LOG_HEAD_BYTES = 256
+
+# above this fraction of lines containing the needle, searching for it costs
+# more than it saves
+NEEDLE_MAX_DENSITY = 0.25
+
+
+def stats_regex(stat, substat='', val=False):
+    """Returns the regex of the log lines of a stat."""
+    if val:
+        return re.compile(r'\[([1-9][0-9]*)\] \(VAL\).*\|.*%s: .*?%s=?'
+                          r'(\d+\.\d+)' % (stat, substat))
+    return re.compile(r'\[([1-9][0-9]*)\] \((\d+)/(\d+)\).*\|.*%s: .*?%s=?'
+                      r'(\d+\.\d+)' % (stat, substat))
+
+
+def _cache_path(log_path, stats_re, val):
+    key = hashlib.sha1(f'{stats_re.pattern}:{val}'.encode()).hexdigest()[:12]
+    log_dir, log_name = os.path.split(log_path)
+    return os.path.join(log_dir, f'.{log_name}.{key}.npz')
+
+
+def empty_stats():
+    """Returns the stats of an empty log."""
+    return {
+        'ts': np.empty(0, dtype=np.int64),
+        'losses': np.empty(0, dtype=np.float64),
+        'epoch_ts': np.empty(0, dtype=np.int64),
+        'offset': np.int64(0),
+    }
+
+
+def _load_cache(cache_path, log_stat, log_head):
+    try:
+        cache = np.load(cache_path)
+    except (OSError, ValueError):
+        return None
+    with cache:
+        if (int(cache['ino']) != log_stat.st_ino or
+                int(cache['offset']) > log_stat.st_size or
+                bytes(cache['head']) != log_head[:len(cache['head'])]):
+            return None  # truncated or rotated
+        return {k: cache[k] for k in cache.files}
+
+
+def _save_cache(cache_path, **arrays):
+    tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, 'wb') as f_cache:
+            np.savez(f_cache, **arrays)
+        os.replace(tmp_path, cache_path)
+    except OSError:  # e.g. read-only experiment dir; just don't cache
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _candidate_lines(buf, start, end, needle):
+    """Yields the lines of buf[start:end] that contain `needle`."""
+    pos = buf.find(needle, start, end)
+    while pos != -1:
+        line_start = max(buf.rfind(b'\n', start, pos) + 1, start)
+        line_end = buf.find(b'\n', pos, end)
+        if line_end == -1:
+            line_end = end
+        yield buf[line_start:line_end]
+        pos = buf.find(needle, line_end + 1, end)
+
+
+def _parse_lines(lines, stats_re, val):
+    groups = [m.groups() for m in map(stats_re.match, lines) if m]
+    if not groups:
+        return (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64),
+                np.empty(0, dtype=np.int64))
+    fields = np.array(groups)  # the matched byte strings, one row per line
+    losses = fields[:, -1].astype(np.float64)
+    if val:
+        return fields[:, 0].astype(np.int64), losses, np.empty(0, np.int64)
+    epoch, itr, itr_per_epoch = fields[:, :3].astype(np.int64).T
+    ts = (epoch - 1)*itr_per_epoch + itr
+    return ts, losses, ts[itr == itr_per_epoch]
+
+
+def parse_tail(f_stats, stats, stats_re, val, needle):
+    """Appends the stats of the complete lines after `stats['offset']`.
+
+    Returns whether any new lines were parsed.
+    """
+    offset = end = int(stats['offset'])
+    tail = b''
+    if os.fstat(f_stats.fileno()).st_size > offset:
+        with mmap.mmap(f_stats.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            # the last line may be incomplete
+            end = max(buf.rfind(b'\n', offset) + 1, offset)
+            tail = buf[offset:end]
+    if end == offset:
+        return False
+    if needle and (tail.count(needle.encode()) <
+                   NEEDLE_MAX_DENSITY * tail.count(b'\n')):
+        lines = _candidate_lines(tail, 0, len(tail), needle.encode())
+    else:
+        lines = tail.splitlines()
+    bytes_re = re.compile(stats_re.pattern.encode())
+    ts, losses, epoch_ts = _parse_lines(lines, bytes_re, val)
+    stats['ts'] = np.concatenate((stats['ts'], ts))
+    stats['losses'] = np.concatenate((stats['losses'], losses))
+    stats['epoch_ts'] = np.concatenate((stats['epoch_ts'], epoch_ts))
+    stats['offset'] = np.int64(end)
+    return True
+
+
+def read_log(log_path, stats_re, val=False, needle=None):
+    """Returns the stats of a stat in the log at `log_path`: a dict of the
+    `ts`, `losses` and `epoch_ts` arrays, along with the `ino` of the log
+    and the byte `offset` up to which it was parsed.
+
+    If given, only lines containing the `needle` string (e.g. the stat name)
+    are matched against the regex.
+    """
+    cache_path = _cache_path(log_path, stats_re, val)
+    with open(log_path, 'rb') as f_stats:
+        log_stat = os.fstat(f_stats.fileno())
+        log_head = f_stats.read(LOG_HEAD_BYTES)
+        stats = _load_cache(cache_path, log_stat, log_head) or empty_stats()
+        stats['ino'] = np.int64(log_stat.st_ino)
+        stats['head'] = np.frombuffer(log_head, dtype=np.uint8)
+        if parse_tail(f_stats, stats, stats_re, val, needle):
+            _save_cache(cache_path, **stats)
+    return stats
@@ -0,0 +1,306 @@
+"""An append-only binary file of the metrics reported by an experiment.
+
+The training program appends records with a `Writer`:
+
+    from em import metrics
+
+    writer = metrics.Writer()
+    ...
+    writer.write('loss/total', loss, step, epoch)
+
+Records are fixed-size (step, epoch, name id, value) structs in
+`run/metrics.bin`. Metric names are numbered in order of first use and kept
+one per line in `run/metrics.names`. Readers memory-map the records instead
+of parsing them.
+
+`em` folds the records into per-metric summaries in the project database
+as they are written, so experiments can be ranked without reading them.
+Programs that only print their stats to `run/log.txt` are summarized too:
+the stats configured in `experiment.summary_stats` are parsed from the log
+by `em.logstats` and summarized under the same names.
+"""
+import atexit
+import math
+import os
+from os import path as osp
+import struct
+import sys
+import time
+
+from em import db
+
+RECORDS_FILE = 'metrics.bin'
+NAMES_FILE = 'metrics.names'
+LOG_FILE = 'log.txt'
+
+RECORD = struct.Struct('<qiId')  # step, epoch, name id, value
+
+# min and max are of the finite values; `epochs` is the number of epochs
+# in which values were recorded
+SUMMARY_FIELDS = ('count', 'min', 'min_step', 'max', 'max_step', 'last',
+                  'last_step', 'epochs', 'last_epoch')
+
+SUMMARY_BATCH = 1 << 16  # records read at a time
+
+E_BAD_NAME = 'metric names cannot contain newlines: {!r}'
+W_NO_LOGSTATS = ('warning: summary_stats are not summarized from logs since '
+                 'em.logstats cannot be imported: {}')
+
+
+def _write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+class Writer:
+    """Appends metric records to the files in `run_dir`.
+
+    Records are buffered and written `batch_size` at a time, or after
+    `max_delay` seconds, so writing a metric costs about as much as a dict
+    lookup. Buffered records are written when the program exits.
+    """
+
+    def __init__(self, run_dir='run', batch_size=1024, max_delay=5):
+        os.makedirs(run_dir, exist_ok=True)
+        self.run_dir = run_dir
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.name_ids = {name: i for i, name in enumerate(names(run_dir))}
+        self._buf = bytearray()
+        self._nbuffered = 0
+        self._last_flush = time.monotonic()
+        self._fd = os.open(osp.join(run_dir, RECORDS_FILE),
+                           os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        atexit.register(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _add_name(self, name):
+        if '\n' in name:
+            raise ValueError(E_BAD_NAME.format(name))
+        # names are written right away so that readers never see a record
+        # before its name
+        names_fd = os.open(osp.join(self.run_dir, NAMES_FILE),
+                           os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            _write_all(names_fd, (name + '\n').encode())
+        finally:
+            os.close(names_fd)
+        self.name_ids[name] = len(self.name_ids)
+        return self.name_ids[name]
+
+    def write(self, name, value, step, epoch=0):
+        """Records the value of a metric at a training step."""
+        name_id = self.name_ids.get(name)
+        if name_id is None:
+            name_id = self._add_name(name)
+        self._buf += RECORD.pack(step, epoch, name_id, value)
+        self._nbuffered += 1
+        if (self._nbuffered >= self.batch_size or
+                time.monotonic() - self._last_flush >= self.max_delay):
+            self.flush()
+
+    def flush(self):
+        """Writes the buffered records."""
+        if self._buf:
+            _write_all(self._fd, self._buf)
+            self._buf = bytearray()
+            self._nbuffered = 0
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        """Writes the buffered records and closes the file."""
+        if self._fd is None:
+            return
+        self.flush()
+        os.close(self._fd)
+        self._fd = None
+        atexit.unregister(self.close)
+
+
+def names(run_dir='run'):
+    """Returns the names of the metrics recorded in `run_dir`."""
+    try:
+        with open(osp.join(run_dir, NAMES_FILE)) as f_names:
+            return f_names.read().split('\n')[:-1]  # skip a partial line
+    except FileNotFoundError:
+        return []
+
+
+def count(run_dir='run'):
+    """Returns the number of complete records in `run_dir`."""
+    try:
+        return osp.getsize(osp.join(run_dir, RECORDS_FILE)) // RECORD.size
+    except FileNotFoundError:
+        return 0
+
+
+def read(run_dir, name, start=0):
+    """Returns (steps, epochs, values, end) arrays of the records of a metric.
+
+    Only records from index `start` on are read; pass `end` as the `start`
+    of the next call to read just the records written since.
+    """
+    import numpy as np
+
+    dtype = np.dtype([('step', '<i8'), ('epoch', '<i4'), ('name', '<u4'),
+                      ('value', '<f8')])
+    empty = (np.empty(0, np.int64), np.empty(0, np.int64),
+             np.empty(0, np.float64))
+    metric_names = names(run_dir)
+    if name not in metric_names:
+        return empty + (start,)
+    end = count(run_dir)
+    if end <= start:
+        return empty + (start,)
+    records = np.memmap(osp.join(run_dir, RECORDS_FILE), dtype=dtype,
+                        mode='r', offset=start * RECORD.size,
+                        shape=(end - start,))
+    records = records[records['name'] == metric_names.index(name)]
+    return (records['step'].astype(np.int64),
+            records['epoch'].astype(np.int64),
+            records['value'].astype(np.float64),
+            end)
+
+
+def _new_summary():
+    summary = dict.fromkeys(SUMMARY_FIELDS)
+    summary.update(count=0, epochs=0)
+    return summary
+
+
+def _fold(summary, step, epoch, value):
+    summary['count'] += 1
+    summary['last'], summary['last_step'] = value, step
+    if epoch != summary['last_epoch']:
+        summary['epochs'] += 1
+        summary['last_epoch'] = epoch
+    if not math.isfinite(value):
+        return
+    # on ties, the earlier step is the best
+    if summary['min'] is None or value < summary['min']:
+        summary['min'], summary['min_step'] = value, step
+    if summary['max'] is None or value > summary['max']:
+        summary['max'], summary['max_step'] = value, step
+
+
+def summarize(run_dir, start=0, summaries=None):
+    """Folds the records from index `start` on into `summaries`, a dict of
+    {name: {field: value}} with the fields in SUMMARY_FIELDS.
+
+    Returns (the updated summaries, the index after the last record). Only
+    the new records are read, so this is cheap to call as a run goes on."""
+    summaries = {name: dict(summary)
+                 for name, summary in (summaries or {}).items()}
+    end = count(run_dir)
+    if end <= start:
+        return summaries, start
+    metric_names = names(run_dir)
+    with open(osp.join(run_dir, RECORDS_FILE), 'rb') as f_records:
+        f_records.seek(start * RECORD.size)
+        for i in range(start, end, SUMMARY_BATCH):
+            data = f_records.read(min(SUMMARY_BATCH, end - i) * RECORD.size)
+            for step, epoch, name_id, value in RECORD.iter_unpack(data):
+                if name_id >= len(metric_names):
+                    continue  # unnamed records cannot be summarized
+                summary = summaries.get(metric_names[name_id])
+                if summary is None:
+                    summary = summaries[metric_names[name_id]] = \
+                        _new_summary()
+                _fold(summary, step, epoch, value)
+    return summaries, end
+
+
+def log_stats(config):
+    """Returns the names of the stats to summarize from experiment logs.
+
+    Logs are parsed by `em.logstats`, which needs numpy; without it, this
+    warns and returns no stats."""
+    stats = [stat for stat in config['experiment']['summary_stats'].split(',')
+             if stat]
+    if stats:
+        try:
+            from em import logstats  # pylint: disable=unused-import
+        except ImportError as err:
+            print(W_NO_LOGSTATS.format(err), file=sys.stderr)
+            return []
+    return stats
+
+
+def _fold_parsed(summary, parsed, val):
+    """Folds the values of a stat parsed by `em.logstats.read_log` that
+    `summary` does not count yet into it."""
+    import numpy as np
+    start = summary['count']
+    steps = parsed['ts']
+    # the steps of validation stats are their (1-based) epochs
+    epochs = steps if val else (
+        np.searchsorted(parsed['epoch_ts'], steps) + 1)
+    for step, epoch, value in zip(steps[start:].tolist(),
+                                  epochs[start:].tolist(),
+                                  parsed['losses'][start:].tolist()):
+        _fold(summary, step, epoch, value)
+
+
+def summarize_log(run_dir, stats, summaries, log_offset=(None, None)):
+    """Folds the values of `stats` appended to the log in `run_dir` since
+    they were last summarized, up to `log_offset`, into `summaries`.
+
+    `log_offset` is the (ino, byte offset) of the log that the summaries
+    cover; they are recomputed if the log was replaced or truncated since.
+    Returns (the summaries, the new (ino, byte offset) of the log). The log
+    is parsed incrementally by `em.logstats`, which needs numpy; without it,
+    `summaries` are left as they are."""
+    try:
+        from em import logstats
+    except ImportError:
+        return summaries, log_offset
+    log_path = osp.join(run_dir, LOG_FILE)
+    new_offset = log_offset
+    for stat_name in stats:
+        val = stat_name.startswith('val/')
+        stat, _, substat = (stat_name[len('val/'):] if val else
+                            stat_name).partition('/')
+        try:
+            parsed = logstats.read_log(
+                log_path, logstats.stats_regex(stat, substat, val), val,
+                needle=stat)
+        except FileNotFoundError:
+            break
+        new_offset = (int(parsed['ino']), int(parsed['offset']))
+        summary = summaries.get(stat_name)
+        if (summary is None or new_offset[0] != log_offset[0] or
+                new_offset[1] < (log_offset[1] or 0)):  # rewritten
+            summary = summaries[stat_name] = _new_summary()
+        _fold_parsed(summary, parsed, val)
+    return summaries, new_offset
+
+
+def update_summaries(emdb, name, run_dir, stats=()):
+    """Folds the records an experiment wrote since the last update into its
+    summaries in the database, along with the values of `stats` in its log
+    that it did not record with a `Writer`."""
+    try:
+        ino = os.stat(osp.join(run_dir, RECORDS_FILE)).st_ino
+    except FileNotFoundError:
+        ino = None
+    prev_offsets = db.get_metrics_offset(emdb, name) or (None, 0, None, None)
+    prev_ino, start = prev_offsets[:2]
+    log_offset = prev_offsets[2:]
+    prev_summaries = db.get_metric_summaries(emdb, name)
+    summaries = prev_summaries
+    if ino != prev_ino or count(run_dir) < start:  # the run was restarted
+        summaries, start = {}, 0
+    summaries, end = summarize(run_dir, start, summaries)
+    logged = [stat for stat in stats if stat not in names(run_dir)]
+    if logged:
+        summaries, log_offset = summarize_log(run_dir, logged, summaries,
+                                              log_offset)
+    offsets = (ino, end) + tuple(log_offset)
+    if summaries != prev_summaries or offsets != prev_offsets:
+        db.set_metric_summaries(emdb, name, summaries, offsets)
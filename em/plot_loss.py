@@ -1,14 +1,14 @@
 #!/usr/bin/env python3.6
 
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 import fnmatch
 import os
-import re
-import sys
 
 import numpy as np
-import matplotlib.pyplot as plt
-from scipy.ndimage.filters import median_filter
+
+from em import logstats
+from em import metrics
 
 # PROJ_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 # DATA_ROOT = os.path.join(PROJ_ROOT, 'data')
@@ -17,99 +17,275 @@ from scipy.ndimage.filters import median_filter
 DATA_ROOT = 'data'
 EXP_ROOT = 'experiments'
 
-def read_stats(exp_name, stats_re, val=False):
-    log_path = os.path.join(EXP_ROOT, exp_name, 'run', 'log.txt')
-    ts = []
-    losses = []
-    epoch_ts = []
-    with open(log_path) as f_stats:
-        for l in f_stats:
-            m = stats_re.match(l.rstrip())
-            if not m:
-                continue
-            if val:
-                epoch, loss = m.groups()
-                t = int(epoch)
-            else:
-                epoch, itr, itr_per_epoch, loss = m.groups()
-                t = (int(epoch) - 1)*int(itr_per_epoch) + int(itr)
-                if itr == itr_per_epoch:
-                    epoch_ts.append(t)
-            ts.append(t)
-            losses.append(float(loss))
-
-    return ts, losses, epoch_ts
-
-if __name__ != '__main__':
-    exit()
-
-#======================================================================================
-parser = argparse.ArgumentParser()
-parser.add_argument('exp_names', nargs='+')
-parser.add_argument('--stat', default='loss')
-parser.add_argument('--substat', default='')
-parser.add_argument('--val', action='store_true')
-parser.add_argument('--legend-names', nargs='+', default=[])
-parser.add_argument('--xlim')
-parser.add_argument('--ylim')
-parser.add_argument('--savefig')
-args = parser.parse_args()
-#======================================================================================
-
-if args.val:
-    stats_re = re.compile(r'\[([1-9][0-9]*)\] \(VAL\).*\|.*%s: .*?%s=?(\d+\.\d+)' % (args.stat, args.substat))
-else:
-    stats_re = re.compile(r'\[([1-9][0-9]*)\] \((\d+)/(\d+)\).*\|.*%s: .*?%s=?(\d+\.\d+)' % (args.stat, args.substat))
-
-plt.figure()
-
-min_loss = float('inf')
-max_loss = 0
-epoch_ts = []
-exp_max_iter = {}
-experiments = os.listdir(EXP_ROOT)
-exp_names = sum([fnmatch.filter(experiments, name) for name in args.exp_names], [])
-if not args.legend_names:
-    args.legend_names = exp_names
-for exp_name, legend_name in zip(exp_names, args.legend_names):
-    ts, losses, ets = read_stats(exp_name, stats_re, val=args.val)
-    if not ts:
-        continue
-    exp_max_iter[exp_name] = max(ts)
-    if len(ets) > len(epoch_ts):
-        epoch_ts = ets
-    min_loss = min(min_loss, *losses)
-    max_loss = max(max_loss, *losses)
-    if not args.val:
-        losses = median_filter(losses, size=20, mode='mirror')
-    plt.plot(ts, losses, label=legend_name)
-
-plt.vlines(epoch_ts, ymin=min_loss, ymax=max_loss,
-           linestyles='dashed', linewidth=1)
-
-plt.xlabel('iter')
-plt.ylabel('loss')
-plt.legend()
-
-if args.xlim:
-    if args.xlim == 'min':
-        plt.xlim(0, min(exp_max_iter.values()))
-    elif args.xlim in exp_max_iter:
-        plt.xlim(0, exp_max_iter[args.xlim])
-    else:
-        try:
-            plt.xlim(0, int(args.xlim))
-        except ValueError:
-            pass
-
-if args.ylim:
-    ylims = args.ylim.split(',')
-    if len(ylims) == 2:
-        plt.ylim(*map(float, ylims))
-    else:
-        plt.ylim(None, float(ylims[0]))
-
-if args.savefig is not None:
-    plt.savefig(f'{args.savefig}.eps', bbox_inches='tight')
-plt.show()
-plt.close()
+SMOOTHERS = ('median', 'ema', 'mean', 'none')
+
+def metric_name(stat, substat='', val=False):
+    """Returns the name under which a stat is written with `em.metrics`."""
+    return '/'.join(filter(None, ('val' if val else '', stat, substat)))
+
+def _run_dir(exp_name):
+    return os.path.join(EXP_ROOT, exp_name, 'run')
+
+def _log_path(exp_name):
+    return os.path.join(_run_dir(exp_name), 'log.txt')
+
+def _read_metric(exp_name, stats, val):
+    """Appends the records of `stats['metric']` after `stats['offset']`."""
+    run_dir = _run_dir(exp_name)
+    if metrics.count(run_dir) < stats['offset']:  # the run was restarted
+        stats.update(logstats.empty_stats(),
+                     epochs=np.empty(0, dtype=np.int64))
+        stats.pop('smoothed', None)
+    steps, epochs, values, end = metrics.read(run_dir, stats['metric'],
+                                              int(stats['offset']))
+    stats['offset'] = np.int64(end)
+    if not len(values):
+        return False
+    stats['epochs'] = np.concatenate((stats['epochs'], epochs))
+    stats['ts'] = np.concatenate((stats['ts'], epochs if val else steps))
+    stats['losses'] = np.concatenate((stats['losses'], values))
+    if not val:
+        epoch_ends = np.diff(stats['epochs']) != 0
+        stats['epoch_ts'] = stats['ts'][:-1][epoch_ends]
+    return True
+
+def _read_stats(exp_name, stats_re, val=False, needle=None, metric=None):
+    if metric and metric in metrics.names(_run_dir(exp_name)):
+        stats = logstats.empty_stats()
+        stats.update(metric=metric, epochs=np.empty(0, dtype=np.int64))
+        _read_metric(exp_name, stats, val)
+        return stats
+    return logstats.read_log(_log_path(exp_name), stats_re, val, needle)
+
+def read_stats(exp_name, stats_re, val=False, needle=None, metric=None):
+    """Returns (ts, values, epoch_ts) arrays of a stat in an experiment's log.
+
+    If the experiment wrote the named `metric` with `em.metrics`, it is
+    memory-mapped from there instead. Otherwise, parsed values are cached
+    next to the log along with the byte offset up to which it was parsed, so
+    later calls only parse newly appended lines. If given, only lines
+    containing the `needle` string (e.g. the stat name) are matched against
+    the regex.
+    """
+    stats = _read_stats(exp_name, stats_re, val, needle, metric)
+    return stats['ts'], stats['losses'], stats['epoch_ts']
+
+def follow_stats(exp_name, stats, stats_re, val=False, needle=None):
+    """Parses the lines appended to a log since `stats` was last updated.
+
+    `stats` is updated in place and is parsed anew if the log was replaced or
+    truncated, which also drops its `smoothed` values. Returns whether it
+    changed.
+    """
+    if 'metric' in stats:
+        return _read_metric(exp_name, stats, val)
+    try:
+        log_stat = os.stat(_log_path(exp_name))
+    except FileNotFoundError:
+        return False
+    if (log_stat.st_ino == stats.get('ino') and
+            log_stat.st_size == stats['offset']):
+        return False
+    with open(_log_path(exp_name), 'rb') as f_stats:
+        log_stat = os.fstat(f_stats.fileno())
+        if (log_stat.st_ino != stats.get('ino') or
+                log_stat.st_size < stats['offset']):
+            stats.update(logstats.empty_stats(),
+                         ino=np.int64(log_stat.st_ino))
+            stats.pop('smoothed', None)
+            logstats.parse_tail(f_stats, stats, stats_re, val, needle)
+            return True
+        return logstats.parse_tail(f_stats, stats, stats_re, val, needle)
+
+def smooth(values, smoother, window):
+    """Returns `values` smoothed over a window of `window` points."""
+    from scipy import ndimage, signal
+
+    if smoother == 'none' or window <= 1 or not len(values):
+        return values
+    if smoother == 'median':
+        return ndimage.median_filter(values, size=window, mode='mirror')
+    if smoother == 'mean':
+        return ndimage.uniform_filter1d(values, size=window, mode='mirror')
+    if smoother == 'ema':
+        alpha = 2 / (window + 1)
+        smoothed, _ = signal.lfilter([alpha], [1, alpha - 1], values,
+                                     zi=[(1 - alpha) * values[0]])
+        return smoothed
+    raise ValueError(f'unknown smoother: {smoother}')
+
+def smooth_tail(values, smoothed, smoother, window):
+    """Returns `values` smoothed, given `smoothed`, the smoothed values of a
+    prefix of them.
+
+    Only the points whose windows reach past that prefix are smoothed again,
+    so following a growing series costs time in the number of new points.
+    """
+    from scipy import signal
+    nold = len(smoothed)
+    if not nold or nold > len(values):
+        return smooth(values, smoother, window)
+    if smoother == 'none' or window <= 1:
+        return values
+    if smoother == 'ema':
+        alpha = 2 / (window + 1)
+        tail, _ = signal.lfilter([alpha], [1, alpha - 1], values[nold:],
+                                 zi=[(1 - alpha) * smoothed[-1]])
+        return np.concatenate((smoothed, tail))
+    # the windows of the last points of the prefix were mirrored at its end;
+    # those points are smoothed again with a window of context before them
+    start = max(nold - window, 0)
+    context = max(start - window, 0)
+    tail = smooth(values[context:], smoother, window)[start - context:]
+    return np.concatenate((smoothed[:start], tail))
+
+def decimate(ts, values, max_points):
+    """Returns at most `max_points` points that draw like the full series.
+
+    The series is split into max_points/2 buckets of consecutive points and
+    only the min and max of each bucket are kept, so spikes survive.
+    """
+    if len(ts) <= max_points:
+        return ts, values
+    nbuckets = max(max_points // 2, 1)
+    size = -(-len(ts) // nbuckets)
+    buckets = np.pad(values, (0, nbuckets*size - len(ts)), mode='edge')
+    buckets = buckets.reshape(nbuckets, size)
+    starts = np.arange(nbuckets) * size
+    idxs = np.concatenate((starts + buckets.argmin(axis=1),
+                           starts + buckets.argmax(axis=1)))
+    idxs = np.unique(np.minimum(idxs, len(ts) - 1))  # also sorts
+    return ts[idxs], values[idxs]
+
+def main():
+    import matplotlib.pyplot as plt
+
+    #======================================================================================
+    parser = argparse.ArgumentParser()
+    parser.add_argument('exp_names', nargs='+')
+    parser.add_argument('--stat', default='loss')
+    parser.add_argument('--substat', default='')
+    parser.add_argument('--val', action='store_true')
+    parser.add_argument('--legend-names', nargs='+', default=[])
+    parser.add_argument('--xlim')
+    parser.add_argument('--ylim')
+    parser.add_argument('--savefig')
+    parser.add_argument('--follow', '-f', action='store_true',
+                        help='keep plotting lines appended to the logs')
+    parser.add_argument('--interval', type=float, default=1,
+                        help='seconds between polls of the logs in --follow')
+    parser.add_argument('--smooth', choices=SMOOTHERS,
+                        help='smoother of the values (default: median, or '
+                        'none with --val)')
+    parser.add_argument('--window', type=int, default=20,
+                        help='number of points the smoother spans')
+    parser.add_argument('--max-points', type=int, default=0,
+                        help='max points drawn per series (default: the '
+                        'figure width in pixels)')
+    args = parser.parse_args()
+    #======================================================================================
+
+    stats_re = logstats.stats_regex(args.stat, args.substat, val=args.val)
+    metric = metric_name(args.stat, args.substat, val=args.val)
+
+    if args.smooth is None:
+        args.smooth = 'none' if args.val else 'median'
+
+    def curve(stats):
+        stats['smoothed'] = smooth_tail(stats['losses'],
+                                        stats.get('smoothed', ()),
+                                        args.smooth, args.window)
+        max_points = args.max_points or int(fig.get_figwidth() * fig.dpi)
+        return decimate(stats['ts'], stats['smoothed'], max_points)
+
+    def epoch_segments(exp_stats):
+        exp_stats = [stats for stats in exp_stats if len(stats['ts'])]
+        epoch_ts = max((stats['epoch_ts'] for stats in exp_stats), key=len,
+                       default=[])
+        min_loss = min((stats['losses'].min() for stats in exp_stats),
+                       default=0)
+        max_loss = max((stats['losses'].max() for stats in exp_stats),
+                       default=0)
+        return [[(epoch_t, min_loss), (epoch_t, max_loss)]
+                for epoch_t in epoch_ts]
+
+    def set_xlim(exp_stats):
+        exp_max_iter = {exp_name: stats['ts'].max()
+                        for exp_name, stats in zip(exp_names, exp_stats)
+                        if len(stats['ts'])}
+        if not args.xlim or not exp_max_iter:
+            return
+        if args.xlim == 'min':
+            plt.xlim(0, min(exp_max_iter.values()))
+        elif args.xlim in exp_max_iter:
+            plt.xlim(0, exp_max_iter[args.xlim])
+        else:
+            try:
+                plt.xlim(0, int(args.xlim))
+            except ValueError:
+                pass
+
+    fig = plt.figure()
+
+    experiments = os.listdir(EXP_ROOT)
+    exp_names = sum([fnmatch.filter(experiments, name) for name in args.exp_names], [])
+    if not args.legend_names:
+        args.legend_names = exp_names
+    # logs are parsed in parallel; the needle skips lines without the stat
+    with ProcessPoolExecutor() as pool:
+        exp_stats = list(pool.map(
+            _read_stats, exp_names, [stats_re]*len(exp_names),
+            [args.val]*len(exp_names), [args.stat]*len(exp_names),
+            [metric]*len(exp_names)))
+    lines = []
+    for legend_name, stats in zip(args.legend_names, exp_stats):
+        lines.extend(plt.plot(*curve(stats), label=legend_name))
+    epoch_lines = plt.vlines([], ymin=0, ymax=0, linestyles='dashed',
+                             linewidth=1)
+    epoch_lines.set_segments(epoch_segments(exp_stats))
+
+    plt.xlabel('iter')
+    plt.ylabel('loss')
+    plt.legend()
+
+    set_xlim(exp_stats)
+
+    if args.ylim:
+        ylims = args.ylim.split(',')
+        if len(ylims) == 2:
+            plt.ylim(*map(float, ylims))
+        else:
+            plt.ylim(None, float(ylims[0]))
+
+    if args.savefig is not None:
+        plt.savefig(f'{args.savefig}.eps', bbox_inches='tight')
+
+    if not args.follow:
+        plt.show()
+        plt.close()
+        return
+
+    # the artists of changed logs are updated in place; only the values
+    # appended to them are smoothed
+    plt.show(block=False)
+    try:
+        while plt.fignum_exists(fig.number):
+            plt.pause(args.interval)
+            changed = False
+            for exp_name, stats, line in zip(exp_names, exp_stats, lines):
+                if follow_stats(exp_name, stats, stats_re, args.val,
+                                args.stat):
+                    line.set_data(*curve(stats))
+                    changed = True
+            if changed:
+                epoch_lines.set_segments(epoch_segments(exp_stats))
+                set_xlim(exp_stats)
+                fig.gca().relim()
+                fig.gca().autoscale_view()
+                fig.canvas.draw_idle()
+    except KeyboardInterrupt:
+        pass
+    plt.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+"""Reporting on experiments: their listing, details, logs and resources."""
+import datetime
+import re
+import shutil
+import sys
+
+from em import db
+from em import sched
+from em import util
+
+E_BAD_FILTER = 'error: invalid filter "{}"'
+E_BAD_QUERY = 'error: {}'
+E_NO_SAMPLES = 'error: no resource samples of "{}" (run it with --sample)'
+
+# `em ls` names of fields
+LS_ALIASES = {'host': 'hostname'}
+LS_FILTER_RE = re.compile(
+    r'\s*([\w:]+)\s*(!=|<=|>=|==|=|<|>|\bin\b)\s*(.*?)\s*$')
+TIME_FORMATS = ('%Y-%m-%d', '%Y-%m-%d %H:%M', '%Y-%m-%dT%H:%M',
+                '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S')
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def _parse_value(field, val):
+    val = val.strip().strip('\'"')
+    if field in db.TIME_FIELDS:
+        for time_fmt in TIME_FORMATS:
+            try:
+                return datetime.datetime.strptime(val, time_fmt)
+            except ValueError:
+                pass
+        raise ValueError(val)
+    if field == 'duration' and val[-1:] in DURATION_UNITS:
+        return float(val[:-1]) * DURATION_UNITS[val[-1]]
+    for num_type in (int, float):
+        try:
+            return num_type(val)
+        except ValueError:
+            pass
+    return val
+
+
+def _parse_filter(filt):
+    """Parses an `em ls` filter into a (field, op, value) condition."""
+    match = LS_FILTER_RE.match(filt)
+    if not match or not match.group(3):
+        raise ValueError(filt)
+    field, op, val = match.groups()
+    field = LS_ALIASES.get(field, field)
+    if op == 'in':
+        return field, op, [_parse_value(field, v)
+                           for v in val.strip('()').split(',')]
+    return field, '=' if op == '==' else op, _parse_value(field, val)
+
+
+def _format_field(field, val):
+    if val is None:
+        return '-'
+    if isinstance(val, datetime.datetime):
+        return val.strftime('%Y-%m-%d %H:%M')
+    if field == 'duration':
+        return str(datetime.timedelta(seconds=int(val)))
+    if isinstance(val, float):
+        return f'{val:.6g}'
+    return str(val)
+
+
+def _print_columns(names):
+    """Prints names in as many columns as fit the terminal."""
+    width = max(map(len, names)) + 2
+    ncols = max(shutil.get_terminal_size().columns // width, 1)
+    nrows = -(-len(names) // ncols)
+    for row in range(nrows):
+        print(''.join(name.ljust(width)
+                      for name in names[row::nrows]).rstrip())
+
+
+def _ls_order(args, cols):
+    """Returns the (field, reverse) that `em ls` sorts by. A metric to sort
+    by is added to `cols`, best values first."""
+    sort = LS_ALIASES.get(args.sort, args.sort)
+    reverse = args.reverse
+    sort_metric = db.metric_field(sort)
+    if sort_metric is not None:
+        reverse = reverse != (sort_metric[1] == 'max')
+        if args.sort not in cols:
+            cols.append(args.sort)
+    return sort, reverse
+
+
+def _refresh_summaries(emdb, config):
+    """Brings the metric summaries of all experiments up to date."""
+    from em import metrics
+    log_stats = metrics.log_stats(config)
+    for name in db.names(emdb):
+        metrics.update_summaries(emdb, name, util.expath(name, 'run'),
+                                 log_stats)
+
+
+def _mark_stale(emdb, exps):
+    """Marks the running experiments of `exps` whose jobs are gone."""
+    import socket
+    alive = sched.liveness(emdb, socket.getfqdn())
+    for name, info in exps:
+        if alive.get(name) is False:
+            info['status'] = 'running (stale)'
+
+
+def list_experiments(args, config, _extra_args):
+    """List experiments."""
+    conditions = []
+    for filt in args.filter:
+        try:
+            conditions.append(_parse_filter(filt))
+        except ValueError:
+            return util.die(E_BAD_FILTER.format(filt))
+    cols = args.cols.split(',') if args.cols else []
+    try:
+        sort, reverse = _ls_order(args, cols)
+    except ValueError as err:
+        return util.die(E_BAD_QUERY.format(err))
+    fields = [LS_ALIASES.get(col, col) for col in cols]
+
+    with db.connect() as emdb:
+        if args.refresh:
+            _refresh_summaries(emdb, config)
+        try:
+            exps = db.query(emdb, conditions, fields, sort=sort,
+                            reverse=reverse, limit=args.top)
+        except ValueError as err:
+            return util.die(E_BAD_QUERY.format(err))
+        if 'status' in fields:
+            _mark_stale(emdb, exps)
+    if not exps:
+        return None
+
+    if not cols:
+        _print_columns([name for name, _info in exps])
+        return None
+    util.print_table([['name'] + cols] + [
+        [name] + [_format_field(field, info.get(field)) for field in fields]
+        for name, info in exps])
+    return None
+
+
+def show(args, _config, _extra_args):
+    """Show details about an experiment."""
+    import pickle
+    import pprint
+    import socket
+    name = args.name
+
+    with db.connect() as emdb:
+        info = db.get(emdb, name)
+        if info is not None and info.get('status') == 'running':
+            alive = sched.liveness(emdb, socket.getfqdn())
+            info['liveness'] = 'alive' if alive.get(name) else 'stale'
+    if info is None:
+        return util.die(util.E_NO_EXP.format(name))
+    for info_name, info_val in sorted(info.items()):
+        if isinstance(info_val, datetime.date):
+            info_val = info_val.ctime()
+        print(f'{info_name}: {info_val}')
+
+    if not args.opts:
+        return None
+
+    # the options table holds JSON; the pickle keeps tuples and objects
+    with open(util.expath(name, 'run', 'opts.pkl'), 'rb') as f_opts:
+        print('\noptions:')
+        opts = pickle.load(f_opts)
+        cols = shutil.get_terminal_size((80, 20)).columns
+        pprint.pprint(vars(opts), indent=2, compact=True, width=cols)
+    return None
+
+
+def logs(args, _config, _extra_args):
+    """Print the output of an experiment's job."""
+    from em import capture
+
+    with db.connect() as emdb:
+        if db.get(emdb, args.name) is None:
+            return util.die(util.E_NO_EXP.format(args.name))
+
+    def _is_running():
+        if not args.follow:
+            return False
+        with db.connect() as emdb:
+            info = db.get(emdb, args.name) or {}
+        return info.get('status') in sched.ACTIVE + ('queued',)
+
+    try:
+        capture.follow(util.expath(args.name, 'run'), sys.stdout.buffer,
+                       _is_running)
+    except BrokenPipeError:
+        pass
+
+
+def stats(args, _config, _extra_args):
+    """Summarize the resources used by an experiment's job."""
+    from em import resources
+
+    with db.connect() as emdb:
+        if db.get(emdb, args.name) is None:
+            return util.die(util.E_NO_EXP.format(args.name))
+    samples = resources.read_samples(util.expath(args.name, 'run'))
+    if not samples:
+        return util.die(E_NO_SAMPLES.format(args.name))
+    print(resources.summarize(samples))
+    return None
@@ -0,0 +1,150 @@
+"""Sampling of the resources used by the process tree of a job.
+
+Samples are read from /proc and appended to `run/resources.bin` as
+fixed-size records. Counters (CPU time and I/O) are cumulative, so rates
+are derived from consecutive samples.
+"""
+import collections
+import datetime
+import os
+from os import path as osp
+import struct
+import time
+
+from em import units
+
+SAMPLES_FILE = 'resources.bin'
+
+Sample = collections.namedtuple(
+    'Sample', 'time cpu_secs rss read_bytes write_bytes nthreads nprocs')
+
+_RECORD = struct.Struct('<ddqqqII')
+
+# indices of fields of /proc/<pid>/stat after the command name
+_PPID, _UTIME, _CSTIME, _NTHREADS, _RSS = 1, 11, 14, 17, 21
+
+
+def _read_stat(pid):
+    with open(f'/proc/{pid}/stat', 'rb') as f_stat:
+        # the command name may contain spaces and parentheses
+        return f_stat.read().rpartition(b')')[2].split()
+
+
+def _read_io(pid):
+    try:
+        with open(f'/proc/{pid}/io', 'rb') as f_io:
+            fields = dict(line.split(b': ') for line in f_io)
+    except PermissionError:
+        return 0, 0
+    return int(fields[b'rchar']), int(fields[b'wchar'])
+
+
+def _proc_tree(root_pid):
+    """Returns {pid: stat fields} of a process and all of its descendants."""
+    stats = {}
+    children = collections.defaultdict(list)
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            stats[int(entry)] = stat = _read_stat(entry)
+        except (FileNotFoundError, ProcessLookupError):
+            continue  # exited since listing /proc
+        children[int(stat[_PPID])].append(int(entry))
+    tree = {}
+    pids = [root_pid] if root_pid in stats else []
+    while pids:
+        pid = pids.pop()
+        tree[pid] = stats[pid]
+        pids.extend(children[pid])
+    return tree
+
+
+def sample(root_pid):
+    """Returns the resources used by a process tree or None if it exited.
+
+    CPU time includes that of reaped children. I/O counts the bytes passed
+    to read and write system calls, whether or not they hit the disk."""
+    tick = os.sysconf('SC_CLK_TCK')
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    cpu_ticks = rss = read_bytes = write_bytes = nthreads = 0
+    tree = _proc_tree(root_pid)
+    if not tree:
+        return None
+    for pid, stat in tree.items():
+        cpu_ticks += sum(map(int, stat[_UTIME:_CSTIME + 1]))
+        nthreads += int(stat[_NTHREADS])
+        rss += int(stat[_RSS]) * page_size
+        try:
+            pid_read, pid_write = _read_io(pid)
+        except (FileNotFoundError, ProcessLookupError):
+            continue
+        read_bytes += pid_read
+        write_bytes += pid_write
+    return Sample(time.time(), cpu_ticks / tick, rss, read_bytes,
+                  write_bytes, nthreads, len(tree))
+
+
+class Sampler:
+    """Appends samples of a process tree to the file in `run_dir`."""
+
+    def __init__(self, root_pid, run_dir):
+        os.makedirs(run_dir, exist_ok=True)
+        self.root_pid = root_pid
+        self.path = osp.join(run_dir, SAMPLES_FILE)
+
+    def sample(self):
+        """Records a sample. Returns False once the process has exited."""
+        usage = sample(self.root_pid)
+        if usage is None:
+            return False
+        with open(self.path, 'ab') as f_samples:
+            f_samples.write(_RECORD.pack(*usage))
+        return True
+
+
+def read_samples(run_dir):
+    """Returns the list of samples recorded in `run_dir`."""
+    try:
+        with open(osp.join(run_dir, SAMPLES_FILE), 'rb') as f_samples:
+            data = f_samples.read()
+    except FileNotFoundError:
+        return []
+    data = data[:len(data) - len(data) % _RECORD.size]
+    return [Sample(*fields) for fields in _RECORD.iter_unpack(data)]
+
+
+def _total(samples, field):
+    # counters of children drop out of the sum when they exit, so only the
+    # increases between samples are counted
+    return sum(max(getattr(cur, field) - getattr(prev, field), 0)
+               for prev, cur in zip(samples, samples[1:]))
+
+
+def summarize(samples):
+    """Returns a printable summary of the resource usage of a job."""
+    elapsed = samples[-1].time - samples[0].time
+    peak_rss = max(usage.rss for usage in samples)
+    mean_rss = sum(usage.rss for usage in samples) / len(samples)
+    lines = [
+        f'samples: {len(samples)} over '
+        f'{datetime.timedelta(seconds=int(elapsed))}',
+        f'memory: peak {units.fmt_bytes(peak_rss)}, '
+        f'mean {units.fmt_bytes(mean_rss)}',
+        f'threads: peak {max(usage.nthreads for usage in samples)} in '
+        f'{max(usage.nprocs for usage in samples)} processes',
+    ]
+    if elapsed <= 0:
+        return '\n'.join(lines)
+    peak_cpu = max((cur.cpu_secs - prev.cpu_secs) / (cur.time - prev.time)
+                   for prev, cur in zip(samples, samples[1:])
+                   if cur.time > prev.time)
+    read_rate = _total(samples, 'read_bytes') / elapsed
+    write_rate = _total(samples, 'write_bytes') / elapsed
+    lines += [
+        f'cpu: mean {_total(samples, "cpu_secs") / elapsed:.0%}, '
+        f'peak {peak_cpu:.0%} (100% is one core)',
+        f'io: read {units.fmt_bytes(read_rate)}/s, '
+        f'write {units.fmt_bytes(write_rate)}/s',
+    ]
+    return '\n'.join(lines)
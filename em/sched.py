@@ -0,0 +1,182 @@
+"""A local queue that assigns resource slots to waiting experiments, and
+tracking of whether the jobs of running experiments are still alive."""
+import os
+from os import path as osp
+import time
+
+from em import db
+
+# statuses of experiments that hold their assigned slots
+ACTIVE = ('starting', 'running')
+
+# how often job runners record that their jobs are alive
+HEARTBEAT_SECS = 30
+
+# a job on another host whose last heartbeat is older than this is stale
+STALE_SECS = 4 * HEARTBEAT_SECS
+
+# the file in the run directory of a job whose mtime is its last heartbeat
+HEARTBEAT_FILE = 'heartbeat'
+
+# a queued experiment whose job has not started this long after it was
+# launched is presumed to have died and gives up its slots
+LAUNCH_TIMEOUT_SECS = 10 * 60
+
+
+def enqueue(emdb, name, prog_args=None, priority=0, nslots=1,
+            queued_at=None):
+    """Puts an experiment at the back of the queue for its priority."""
+    # pylint: disable=too-many-arguments
+    with db.transaction(emdb):
+        last_seq = emdb.execute(
+            'SELECT MAX(queue_seq) FROM experiments').fetchone()[0]
+        return db.transition(emdb, name, 'queued',
+                             queue_seq=(last_seq or 0) + 1,
+                             queued=queued_at,
+                             priority=priority,
+                             nslots=nslots,
+                             slots=None,
+                             prog_args=prog_args)
+
+
+def queued(emdb):
+    """Returns the (name, info) of queued experiments in launch order."""
+    return [(row['name'], db.get(emdb, row['name'])) for row in emdb.execute(
+        'SELECT name FROM experiments WHERE status = ? '
+        'ORDER BY priority DESC, queue_seq', ('queued',))]
+
+
+def busy_slots(emdb):
+    """Returns the slots held by active experiments."""
+    marks = ', '.join('?' * len(ACTIVE))
+    busy = set()
+    for row in emdb.execute(
+            'SELECT slots FROM experiments WHERE slots IS NOT NULL '
+            f'AND status IN ({marks})', ACTIVE):
+        busy.update(row['slots'].split(','))
+    return busy
+
+
+def stalled_launches(emdb, timeout=LAUNCH_TIMEOUT_SECS):
+    """Returns the names of experiments that were launched on slots more
+    than `timeout` seconds ago and whose jobs never started."""
+    return [row['name'] for row in emdb.execute(
+        'SELECT name FROM experiments WHERE status = ? '
+        'AND slots IS NOT NULL AND (heartbeat IS NULL OR heartbeat < ?)',
+        ('starting', time.time() - timeout))]
+
+
+def _fail_launches(emdb, names):
+    for name in names:
+        db.transition(emdb, name, 'error', from_status='starting',
+                      heartbeat=None)
+
+
+def schedule(emdb, slots, max_jobs=0):
+    """Assigns free slots to queued experiments.
+
+    Experiments are started strictly in queue order, so one that needs more
+    slots than are free blocks those behind it rather than starving; one
+    that needs more slots than there are would block them forever, so it is
+    skipped. Stalled launches release their slots first. Returns (name,
+    assigned_slots, prog_args) of the experiments to launch, which have been
+    moved to the `starting` state."""
+    launches = []
+    with db.transaction(emdb):
+        _fail_launches(emdb, stalled_launches(emdb))
+        busy = busy_slots(emdb)
+        free = [slot for slot in slots if slot not in busy]
+        marks = ', '.join('?' * len(ACTIVE))
+        njobs = emdb.execute(
+            'SELECT COUNT(*) FROM experiments WHERE slots IS NOT NULL '
+            f'AND status IN ({marks})', ACTIVE).fetchone()[0]
+        for name, info in queued(emdb):
+            nslots = info.get('nslots') or 1
+            if nslots > len(slots):
+                continue
+            if (max_jobs and njobs >= max_jobs) or nslots > len(free):
+                break
+            assigned, free = free[:nslots], free[nslots:]
+            # the heartbeat of a launch is when it was launched
+            db.transition(emdb, name, 'starting', from_status='queued',
+                          slots=','.join(assigned), heartbeat=time.time())
+            launches.append((name, assigned, info.get('prog_args') or []))
+            njobs += 1
+    return launches
+
+
+def pin_cpus(cpus):
+    """Returns a `preexec_fn` that pins a job to `cpus`, or None if `cpus`
+    is empty."""
+    import functools
+    return functools.partial(os.sched_setaffinity, 0, cpus) if cpus else None
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def beat(run_dir, pid):
+    """Records that the job `pid` of the run in `run_dir` is alive.
+
+    Heartbeats go to a file rather than the database, which may be on a
+    filesystem shared with other hosts."""
+    import socket
+    os.makedirs(run_dir, exist_ok=True)
+    beat_path = osp.join(run_dir, HEARTBEAT_FILE)
+    with open(beat_path + '.tmp', 'w') as f_beat:
+        f_beat.write(f'{time.time():.3f} {socket.getfqdn()} {pid}\n')
+    os.replace(beat_path + '.tmp', beat_path)
+
+
+def _last_beat(proj_dir, name):
+    try:
+        return os.stat(osp.join(proj_dir, 'experiments', name, 'run',
+                                HEARTBEAT_FILE)).st_mtime
+    except FileNotFoundError:
+        return None
+
+
+def liveness(emdb, hostname, stale_secs=STALE_SECS, proj_dir='.'):
+    """Returns {name: is_alive} for all running experiments.
+
+    A job on this host is alive while its process is. A job on another host
+    is alive while its last heartbeat, or its start if it never beat, is
+    newer than `stale_secs`."""
+    cutoff = time.time() - stale_secs
+    alive = {}
+    for row in emdb.execute(
+            'SELECT name, hostname, pid, heartbeat, started '
+            'FROM experiments WHERE status = ?', ('running',)):
+        if row['hostname'] == hostname and row['pid']:
+            alive[row['name']] = _pid_alive(row['pid'])
+            continue
+        beats = [beat_time for beat_time in
+                 (row['heartbeat'], _last_beat(proj_dir, row['name']))
+                 if beat_time is not None]
+        last_seen = max(beats) if beats else row['started']
+        alive[row['name']] = last_seen is None or last_seen >= cutoff
+    return alive
+
+
+def reap(emdb, hostname, stale_secs=STALE_SECS, dry_run=False):
+    """Marks running experiments whose jobs are gone as interrupted, and
+    launches whose jobs never started as errors.
+
+    Returns the names of those experiments."""
+    with db.transaction(emdb):
+        stale = [name for name, is_alive in
+                 liveness(emdb, hostname, stale_secs).items()
+                 if not is_alive]
+        stalled = stalled_launches(emdb)
+        if not dry_run:
+            for name in stale:
+                db.job_ended(emdb, name, 'interrupted')
+            _fail_launches(emdb, stalled)
+    return sorted(stale + stalled)
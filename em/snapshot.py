@@ -0,0 +1,291 @@
+"""Scanning, snapshotting and checking out experiment sources."""
+import collections
+import os
+from os import path as osp
+import stat
+import time
+
+import pygit2
+
+from em import db
+from em import store
+from em import trash
+from em import units
+
+# directories of a project that never contain experiment sources
+SKIP_DIRS = {'.git', 'experiments', 'data', store.STORE_DIR, trash.TRASH_DIR}
+
+# files modified this recently are not cached since a write within the same
+# mtime tick would go unnoticed
+RACY_SECS = 2
+
+BLOB_MODES = {pygit2.GIT_FILEMODE_BLOB, pygit2.GIT_FILEMODE_BLOB_EXECUTABLE,
+              pygit2.GIT_FILEMODE_LINK}
+
+SrcFile = collections.namedtuple('SrcFile', 'path oid mode')
+
+Scan = collections.namedtuple(
+    'Scan', 'changed deleted nfiles ncached nhashed elapsed hash_time')
+
+Checkout = collections.namedtuple(
+    'Checkout', 'nfiles nlinked bytes_written bytes_linked bytes_full')
+
+LINK_MODES = ('copy', 'reflink', 'hardlink')
+
+# number of sibling experiments searched for reusable files
+MAX_SIBLINGS = 4
+
+
+def tracked_exts(config):
+    """Returns the set of file extensions of experiment sources."""
+    return set(config['experiment']['track_files'].split(','))
+
+
+def _is_tracked(filename, exts):
+    return osp.splitext(filename)[1][1:] in exts
+
+
+def tree_blobs(repo, tree, exts=None, prefix=''):
+    """Returns {path: (oid, filemode)} for the (tracked) blobs of `tree`."""
+    blobs = {}
+    for entry in tree:
+        entry_path = prefix + entry.name
+        if entry.filemode == pygit2.GIT_FILEMODE_TREE:
+            blobs.update(tree_blobs(repo, repo[entry.id], exts,
+                                    entry_path + '/'))
+        elif entry.filemode in BLOB_MODES:
+            if exts is None or _is_tracked(entry.name, exts):
+                blobs[entry_path] = (entry.id, entry.filemode)
+    return blobs
+
+
+def varying_entries(repo, trees, prefix=''):
+    """Returns [(path, entries)] of the files that differ between `trees`,
+    where `entries` holds the (oid, filemode) of the file in each tree or
+    None where it is missing.
+
+    Subtrees with the same id in all trees are skipped without being read,
+    so the cost depends on the size of the differences."""
+    varying = []
+    tree_entries = [{entry.name: (entry.id, entry.filemode) for entry in tree}
+                    for tree in trees]
+    for name in sorted(set().union(*tree_entries)):
+        entries = [entries.get(name) for entries in tree_entries]
+        if len(set(entries)) == 1:
+            continue
+        entry_path = prefix + name
+        if all(entry is not None and entry[1] == pygit2.GIT_FILEMODE_TREE
+               for entry in entries):
+            varying += varying_entries(
+                repo, [repo[oid] for oid, _mode in entries],
+                entry_path + '/')
+        else:
+            varying.append((entry_path, entries))
+    return varying
+
+
+def _filemode(st_mode):
+    if stat.S_ISLNK(st_mode):
+        return pygit2.GIT_FILEMODE_LINK
+    if st_mode & 0o100:  # git only looks at the owner bit
+        return pygit2.GIT_FILEMODE_BLOB_EXECUTABLE
+    return pygit2.GIT_FILEMODE_BLOB
+
+
+def _walk_src(repo, exts):
+    workdir = repo.workdir
+    for dirpath, dirnames, filenames in os.walk(workdir):
+        reldir = osp.relpath(dirpath, workdir)
+        reldir = '' if reldir == '.' else reldir + '/'
+        dirnames[:] = [
+            dirname for dirname in dirnames
+            if not (reldir == '' and dirname in SKIP_DIRS) and
+            dirname != '.git' and
+            not repo.path_is_ignored(reldir + dirname + '/')]
+        for filename in filenames:
+            if _is_tracked(filename, exts):
+                yield reldir + filename
+
+
+def scan(repo, emdb, exts):
+    """Finds tracked source files that differ from HEAD.
+
+    Only files with a tracked extension are visited and the walk never
+    enters `experiments/`, `data/` or ignored directories. Files whose
+    inode, mtime and size match the cache of the last scan are not rehashed.
+    A file of HEAD counts as deleted only if it is missing from the disk, so
+    files committed under skipped directories are kept.
+    """
+    # pylint: disable=too-many-locals
+    start = time.perf_counter()
+    workdir = repo.workdir
+    head_blobs = {}
+    if not repo.head_is_unborn:
+        head_tree = repo.head.peel(pygit2.Commit).tree
+        head_blobs = tree_blobs(repo, head_tree, exts)
+    cache = db.get_stat_cache(emdb, workdir)
+
+    changed = []
+    seen = set()
+    new_cache = {}
+    ncached = nhashed = 0
+    hash_time = 0.
+    racy_ns = (time.time() - RACY_SECS) * 1e9
+    for relpath in _walk_src(repo, exts):
+        if relpath not in head_blobs and repo.path_is_ignored(relpath):
+            continue
+        seen.add(relpath)
+        filepath = osp.join(workdir, relpath)
+        try:
+            fstat = os.lstat(filepath)
+        except FileNotFoundError:
+            continue
+        key = (fstat.st_ino, fstat.st_mtime_ns, fstat.st_size)
+        cached = cache.get(relpath)
+        if cached and cached[:3] == key:
+            oid = pygit2.Oid(hex=cached[3])
+            ncached += 1
+        else:
+            hash_start = time.perf_counter()
+            if osp.islink(filepath):
+                oid = pygit2.hash(os.readlink(filepath))
+            else:
+                oid = pygit2.hashfile(filepath)
+            hash_time += time.perf_counter() - hash_start
+            nhashed += 1
+        if fstat.st_mtime_ns < racy_ns:
+            new_cache[relpath] = key + (str(oid),)
+        head_blob = head_blobs.get(relpath)
+        mode = _filemode(fstat.st_mode)
+        if head_blob is None or head_blob != (oid, mode):
+            changed.append(SrcFile(relpath, oid, mode))
+    deleted = sorted(
+        relpath for relpath in head_blobs.keys() - seen
+        if not osp.lexists(osp.join(workdir, relpath)))
+
+    if new_cache != cache:
+        db.set_stat_cache(emdb, workdir, new_cache)
+
+    return Scan(changed, deleted, len(seen), ncached, nhashed,
+                time.perf_counter() - start, hash_time)
+
+
+def build_tree(repo, base_tree, src_scan):
+    """Writes the tree of `base_tree` updated with the scanned changes.
+
+    The tree is assembled in an in-memory index, so neither the repository
+    index nor the working tree is modified. Deleted paths are dropped only if
+    they are in `base_tree` and still missing from the working tree."""
+    index = pygit2.Index()
+    index.read_tree(base_tree)
+    for src in src_scan.changed:
+        oid = src.oid
+        if oid not in repo:
+            # the file may have changed since it was scanned; the snapshot
+            # holds what was written
+            filepath = osp.join(repo.workdir, src.path)
+            if src.mode == pygit2.GIT_FILEMODE_LINK:
+                oid = repo.create_blob(os.readlink(filepath))
+            else:
+                oid = repo.create_blob_fromdisk(filepath)
+        index.add(pygit2.IndexEntry(src.path, oid, src.mode))
+    for path in src_scan.deleted:
+        if path in index and not osp.lexists(osp.join(repo.workdir, path)):
+            index.remove(path)
+    return index.write_tree(repo)
+
+
+def _cached_oid(emdb, root, relpath):
+    """Returns the blob id of a file using the stat cache of `root`."""
+    filepath = osp.join(root, relpath)
+    fstat = os.lstat(filepath)
+    key = (fstat.st_ino, fstat.st_mtime_ns, fstat.st_size)
+    cached = db.get_stat_cache(emdb, root, relpath)
+    if cached and cached[:3] == key:
+        return pygit2.Oid(hex=cached[3])
+    oid = pygit2.hashfile(filepath)
+    db.update_stat_cache(emdb, root, {relpath: key + (str(oid),)})
+    return oid
+
+
+def _sibling_files(repo, siblings):
+    """Returns {(oid, mode): (sibling_dir, path)} of checked out blobs."""
+    sibling_files = {}
+    for sibling_dir, commit_id in siblings:
+        if not osp.isdir(sibling_dir):
+            continue
+        sibling_tree = repo[commit_id].peel(pygit2.Tree)
+        for relpath, blob in tree_blobs(repo, sibling_tree).items():
+            if blob[1] != pygit2.GIT_FILEMODE_LINK:
+                sibling_files.setdefault(blob, (sibling_dir, relpath))
+    return sibling_files
+
+
+def materialize(repo, emdb, tree, exper_dir, siblings=(), link_mode='copy',
+                exts=None):
+    """Writes the blobs of `tree` into `exper_dir`.
+
+    Files whose content is already checked out in one of the `siblings`
+    ((dir, commit_id) pairs) are reflinked or hardlinked from there when
+    `link_mode` allows it and the filesystem supports it. If `exts` is
+    given, only files with those extensions are written (a sparse checkout).
+    """
+    # pylint: disable=too-many-locals,too-many-arguments
+    sibling_files = {}
+    if link_mode != 'copy':
+        sibling_files = _sibling_files(repo, siblings)
+    link = store.reflink if link_mode == 'reflink' else os.link
+
+    nfiles = nlinked = bytes_written = bytes_linked = bytes_full = 0
+    for relpath, (oid, mode) in sorted(tree_blobs(repo, tree).items()):
+        blob = repo[oid]
+        bytes_full += blob.size
+        if exts is not None and not _is_tracked(osp.basename(relpath), exts):
+            continue
+        nfiles += 1
+        dst_path = osp.join(exper_dir, relpath)
+        os.makedirs(osp.dirname(dst_path), exist_ok=True)
+        if mode == pygit2.GIT_FILEMODE_LINK:
+            os.symlink(blob.data, dst_path)
+            continue
+
+        sibling = sibling_files.get((oid, mode))
+        if sibling is not None:
+            try:
+                if _cached_oid(emdb, *sibling) == oid:
+                    link(osp.join(*sibling), dst_path)
+                    nlinked += 1
+                    bytes_linked += blob.size
+                    continue
+            except OSError as err:
+                if err.errno in store.ELINK:
+                    sibling_files = {}  # unsupported; stop trying
+                elif not isinstance(err, FileNotFoundError):
+                    raise
+
+        with open(dst_path, 'wb') as f_dst:
+            f_dst.write(blob.data)
+        if mode == pygit2.GIT_FILEMODE_BLOB_EXECUTABLE:
+            os.chmod(dst_path, 0o755)
+        bytes_written += blob.size
+
+    return Checkout(nfiles, nlinked, bytes_written, bytes_linked, bytes_full)
+
+
+def format_checkout(checkout):
+    """Returns a summary of the bytes written by a checkout."""
+    return (f'checkout: {checkout.nfiles} files ({checkout.nlinked} linked), '
+            f'wrote {units.fmt_bytes(checkout.bytes_written)}, '
+            f'linked {units.fmt_bytes(checkout.bytes_linked)}; a full '
+            f'checkout writes {units.fmt_bytes(checkout.bytes_full)}')
+
+
+def format_timing(src_scan):
+    """Returns a summary of the time spent (and saved) scanning sources."""
+    summary = (f'source scan: {src_scan.elapsed:.3f}s, '
+               f'{src_scan.nfiles} files '
+               f'({src_scan.ncached} cached, {src_scan.nhashed} hashed)')
+    if src_scan.nhashed and src_scan.ncached:
+        saved = src_scan.hash_time / src_scan.nhashed * src_scan.ncached
+        summary += f', ~{saved:.3f}s saved by cache'
+    return summary
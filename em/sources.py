@@ -0,0 +1,304 @@
+"""Checking out, archiving and rehydrating the sources of experiments."""
+import os
+from os import path as osp
+import sys
+
+from em import db
+from em import sched
+from em import util
+
+E_ARCHIVE_MODIFIED = 'error: experiment "{}" has uncommitted source changes'
+E_CANT_ARCHIVE = 'error: could not archive {}'
+
+ARCHIVED = 'Archived {:d} experiments.'
+
+# the namespace of the refs of archived experiments, which are not branches
+# so that they do not slow down enumerating the branches of the project
+ARCHIVE_REF = 'refs/em/archive/{}'
+
+# an empty commit from which linked and sparse worktrees are created before
+# their files are materialized; the ref keeps it from being garbage
+EMPTY_CHECKOUT_REF = 'refs/em/empty-checkout'
+
+
+def _index_snapshots(repo, emdb):
+    import pygit2
+    snapshots = []
+    for name in db.names(emdb):
+        br = util.get_branch(repo, name)
+        if br is None:
+            continue
+        commit = br.peel(pygit2.Commit)
+        snapshots.append((name, commit.tree_id, commit.id))
+    db.reindex_snapshots(emdb, snapshots)
+
+
+def _find_snapshot(repo, emdb, tree_id):
+    """Returns an experiment commit with the tree `tree_id`, if any."""
+    for attempt in range(2):
+        snapshots = db.find_snapshots(emdb, tree_id)
+        if snapshots is None:  # never indexed
+            _index_snapshots(repo, emdb)
+            snapshots = db.find_snapshots(emdb, tree_id)
+        for name, commit_id in snapshots:
+            br = util.get_branch(repo, name)
+            if br is not None and str(br.target) == commit_id:
+                return repo[br.target]
+        if not snapshots or attempt:
+            return None
+        _index_snapshots(repo, emdb)  # stale; rebuild from the refs
+    return None
+
+
+def snapshot_commit(repo, config, base_commit=None, desc=None,
+                    timing=False):
+    """Returns the commit on which to base a new experiment.
+
+    Source changes are snapshotted into a new commit on top of HEAD (or an
+    identical existing snapshot) without touching the main worktree, its
+    index or the stash."""
+    import pygit2
+    from em import snapshot
+    head_commit = repo.head.peel(pygit2.Commit)
+
+    with db.connect() as emdb:
+        src_scan = snapshot.scan(repo, emdb, snapshot.tracked_exts(config))
+        if timing:
+            print(snapshot.format_timing(src_scan), file=sys.stderr)
+        if not src_scan.changed and not src_scan.deleted:
+            return head_commit
+        if base_commit is not None:
+            return base_commit
+
+        snap_tree_id = snapshot.build_tree(repo, head_commit.tree, src_scan)
+        existing_commit = _find_snapshot(repo, emdb, snap_tree_id)
+    if existing_commit is not None:
+        return existing_commit
+
+    sig = repo.default_signature
+    snap_commit_id = repo.create_commit(None, sig, sig,
+                                        desc or 'setup experiment',
+                                        snap_tree_id, [head_commit.id])
+    return repo[snap_commit_id]
+
+
+def _empty_checkout_commit(repo):
+    """Returns the empty commit of the project, creating it once."""
+    empty_ref = repo.references.get(EMPTY_CHECKOUT_REF)
+    if empty_ref is not None:
+        return repo[empty_ref.target]
+    sig = repo.default_signature
+    empty_commit_id = repo.create_commit(None, sig, sig, 'empty checkout',
+                                         repo.TreeBuilder().write(), [])
+    repo.references.create(EMPTY_CHECKOUT_REF, empty_commit_id, force=True)
+    return repo[empty_commit_id]
+
+
+def _add_worktree(name, repo, exper_commit, link_mode='copy', sparse=False,
+                  config=None, siblings=()):
+    # pylint: disable=too-many-arguments
+    """Checks out `exper_commit` into a new worktree for experiment `name`.
+
+    With the default link mode and no sparse profile, libgit2 checks out
+    the whole tree. Otherwise the worktree is created from an empty commit
+    and its files are materialized by `snapshot.materialize`, reusing the
+    checkouts of `siblings` and other known experiments."""
+    import pygit2
+    from em import snapshot
+    exper_dir = util.expath(name)
+    if link_mode == 'copy' and not sparse:
+        br = repo.create_branch(name, exper_commit)
+        repo.add_worktree(name, exper_dir, br)
+        return None
+
+    br = repo.create_branch(name, _empty_checkout_commit(repo))
+    repo.add_worktree(name, exper_dir, br)
+    br.set_target(exper_commit.id)
+
+    with db.connect() as emdb:
+        siblings = list(siblings) + sorted(
+            ((util.expath(sib_name), commit_id)
+             for sib_name, _tree_id, commit_id in db.all_snapshots(emdb)
+             if sib_name != name),
+            key=lambda sib: sib[1] != str(exper_commit.id))
+        checkout = snapshot.materialize(
+            repo, emdb, exper_commit.tree, exper_dir,
+            siblings=siblings[:snapshot.MAX_SIBLINGS], link_mode=link_mode,
+            exts=snapshot.tracked_exts(config) if sparse else None)
+
+    workdir = pygit2.Repository(exper_dir)
+    workdir.index.read_tree(exper_commit.tree)
+    workdir.index.write()
+    return checkout
+
+
+def setup_experiment_dir(name, repo, exper_commit, config, link_mode=None,
+                         sparse=False, siblings=()):
+    """Checks out `exper_commit` into the directory of an experiment."""
+    # pylint: disable=too-many-arguments
+    exper_dir = util.expath(name)
+    checkout = _add_worktree(
+        name, repo, exper_commit,
+        link_mode or config['experiment']['link_mode'],
+        sparse or config['experiment']['sparse'], config, siblings)
+    os.symlink(osp.abspath('data'), osp.join(exper_dir, 'data'),
+               target_is_directory=True)
+    return checkout
+
+
+def setup_sweep_dirs(names, exper_commit, config, link_mode=None,
+                     sparse=False, jobs=None):
+    """Checks out `exper_commit` into the directories of the experiments of
+    a sweep, `jobs` at a time."""
+    # pylint: disable=too-many-arguments
+    from concurrent.futures import ThreadPoolExecutor
+    import pygit2
+    from em import snapshot
+
+    def _setup(name, siblings=()):
+        thread_repo = pygit2.Repository('.')
+        return setup_experiment_dir(name, thread_repo,
+                                    thread_repo[exper_commit.id], config,
+                                    link_mode, sparse, siblings)
+
+    # the first worktree can then be linked into by the others
+    checkouts = [_setup(names[0])]
+    siblings = [(util.expath(names[0]), str(exper_commit.id))]
+    with ThreadPoolExecutor(jobs or None) as pool:
+        checkouts.extend(pool.map(lambda name: _setup(name, siblings),
+                                  names[1:]))
+    checkouts = [checkout for checkout in checkouts if checkout is not None]
+    if checkouts:
+        print(snapshot.format_checkout(snapshot.Checkout(
+            *map(sum, zip(*checkouts)))), file=sys.stderr)
+
+
+def create_experiment(name, repo, config, base_commit=None, desc=None,
+                      timing=False, link_mode=None, sparse=False):
+    """Snapshots the project sources and checks them out for a new
+    experiment."""
+    # pylint: disable=too-many-arguments
+    from em import snapshot
+    exper_commit = snapshot_commit(repo, config, base_commit, desc, timing)
+
+    checkout = setup_experiment_dir(name, repo, exper_commit, config,
+                                     link_mode, sparse)
+    if checkout is not None:
+        print(snapshot.format_checkout(checkout), file=sys.stderr)
+
+    with db.connect() as emdb:
+        db.add_snapshot(emdb, name, exper_commit.tree_id, exper_commit.id)
+
+
+def experiment_commit(repo, name):
+    """Returns the source commit of an experiment, even if it is archived."""
+    import pygit2
+    ref = (util.get_branch(repo, name) or
+           repo.references.get(ARCHIVE_REF.format(name)))
+    return ref.peel(pygit2.Commit) if ref is not None else None
+
+
+def _undo_setup(name, repo):
+    """Removes what a failed `setup_experiment_dir` left behind."""
+    from em import trash
+    trash.move(util.expath(name), trash.trash_path())
+    prune_worktree(repo, name)
+    br = util.get_branch(repo, name)
+    if br is not None:
+        br.delete()
+
+
+def rehydrate(name, repo, config):
+    """Checks out the sources of an archived experiment again."""
+    archived_ref = repo.references.get(ARCHIVE_REF.format(name))
+    if archived_ref is None or util.get_branch(repo, name) is not None:
+        return
+    import pygit2
+    exper_commit = archived_ref.peel(pygit2.Commit)
+    exper_dir = util.expath(name)
+    outputs_dir = f'{exper_dir}.archived'
+    if osp.isdir(exper_dir):
+        os.rename(exper_dir, outputs_dir)
+    try:
+        setup_experiment_dir(name, repo, exper_commit, config)
+    except BaseException:
+        _undo_setup(name, repo)
+        if osp.isdir(outputs_dir):
+            os.rename(outputs_dir, exper_dir)
+        raise
+    if osp.isdir(outputs_dir):
+        for entry in os.scandir(outputs_dir):
+            os.rename(entry.path, osp.join(exper_dir, entry.name))
+        os.rmdir(outputs_dir)
+    archived_ref.delete()
+    with db.connect() as emdb, db.transaction(emdb):
+        db.update(emdb, name, archived=None)
+        db.add_snapshot(emdb, name, exper_commit.tree_id, exper_commit.id)
+
+
+def prune_worktree(repo, name):
+    """Deletes the git worktree metadata of an experiment, if any."""
+    import pygit2
+    try:
+        worktree = repo.lookup_worktree(name)
+        if worktree is not None:
+            worktree.prune(True)
+    except pygit2.GitError:
+        pass
+
+
+def _archive(name, emdb, repo):
+    """Moves the branch of an experiment into the archive and trashes its
+    checkout, keeping `run/`. Returns False if it has no branch."""
+    import pygit2
+    from em import trash
+    br = util.get_branch(repo, name)
+    if br is None:
+        return False
+    exper_dir = util.expath(name)
+    if osp.exists(osp.join(exper_dir, '.git')):
+        # files missing from sparse checkouts show up as deleted
+        unsaved = ~(pygit2.GIT_STATUS_WT_DELETED | pygit2.GIT_STATUS_IGNORED)
+        status = pygit2.Repository(exper_dir).status(untracked_files='no')
+        if any(flags & unsaved for flags in status.values()):
+            raise ValueError(E_ARCHIVE_MODIFIED.format(name))
+    # git steps that may fail go first, so that failing leaves the checkout
+    repo.references.create(ARCHIVE_REF.format(name), br.target, force=True)
+    prune_worktree(repo, name)
+    br.delete()
+    if osp.isdir(exper_dir):
+        for entry in os.scandir(exper_dir):
+            if entry.name != 'run':
+                trash.move(entry.path, trash.trash_path())
+    with db.transaction(emdb):
+        db.update(emdb, name, archived=util.tstamp())
+        db.remove_snapshot(emdb, name)
+        db.set_stat_cache(emdb, exper_dir, {})
+    return True
+
+
+def archive(args, _config, _extra_args):
+    """Archive the sources of finished experiments."""
+    from fnmatch import fnmatch
+    import pygit2
+    from em import trash
+    repo = pygit2.Repository('.')
+
+    narchived = 0
+    with db.connect() as emdb:
+        for name, info in db.items(emdb):
+            is_match = sum(fnmatch(name, patt) for patt in args.name)
+            is_excluded = sum(fnmatch(name, patt) for patt in args.exclude)
+            if (not is_match or is_excluded or 'pid' in info or
+                    info.get('status') in sched.ACTIVE + ('queued',)):
+                continue
+            try:
+                narchived += _archive(name, emdb, repo)
+            except ValueError as err:
+                print(err)
+            except (OSError, pygit2.GitError):
+                print(E_CANT_ARCHIVE.format(name))
+    if narchived:
+        repo.compress_references()
+        trash.spawn_reaper()
+    print(ARCHIVED.format(narchived))
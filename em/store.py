@@ -0,0 +1,272 @@
+"""A content-addressed store that deduplicates experiment checkpoints.
+
+Files in an experiment's `run/snaps` are moved into the project's store under
+the hash of their contents and replaced by hardlinks to the stored file, so
+identical checkpoints of forks and reruns take up space only once. The link
+count of a stored file is its reference count: files that only the store
+links to are garbage. Stored files are made read-only since writing to one
+would change the checkpoints of every experiment that links to it; before a
+job (re)starts, `unshare` gives it private copies of the checkpoints it
+may rewrite.
+"""
+import errno
+import fcntl
+import hashlib
+import os
+from os import path as osp
+import re
+import shutil
+import stat
+import time
+
+from em import db
+
+STORE_DIR = '.em-store'
+
+# files modified this recently may still be being written
+MIN_AGE_SECS = 60
+
+HASH_BLOCK_SIZE = 1 << 20
+
+# ioctl that makes a file share the blocks of another (a reflink)
+FICLONE = 0x40049409  # from linux/fs.h
+
+# errors that mean the filesystem cannot link/clone between these paths
+ELINK = {errno.EXDEV, errno.EOPNOTSUPP, errno.EINVAL, errno.ENOTTY,
+         errno.EPERM, errno.EMLINK, errno.ENOSYS}
+
+
+def store_path(proj_dir='.'):
+    """Returns the path of the store of a project."""
+    return osp.join(osp.abspath(proj_dir), STORE_DIR)
+
+
+def _hash_file(path):
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as f_in:
+        for block in iter(lambda: f_in.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _object_path(store_dir, digest):
+    return osp.join(store_dir, digest[:2], digest[2:])
+
+
+def _replace_with_link(src_path, dst_path):
+    tmp_path = f'{dst_path}.{os.getpid()}.tmp'
+    os.link(src_path, tmp_path)
+    os.replace(tmp_path, dst_path)
+
+
+def _link_to_store(entry, fstat, obj_path, obj_stat):
+    """Replaces the file of `entry` by a link to the stored file `obj_path`,
+    storing the file first if `obj_stat` is None. Returns the bytes saved."""
+    if obj_stat is None:
+        os.makedirs(osp.dirname(obj_path), exist_ok=True)
+        _replace_with_link(osp.realpath(entry.path), obj_path)
+        os.chmod(obj_path, stat.S_IMODE(fstat.st_mode) & 0o555)
+        if entry.is_symlink():
+            _replace_with_link(obj_path, entry.path)
+        return 0
+    _replace_with_link(obj_path, entry.path)
+    return 0 if entry.is_symlink() else fstat.st_size
+
+
+def ingest(emdb, store_dir, snaps_dir, min_age=MIN_AGE_SECS):
+    """Moves the files of `snaps_dir` into the store.
+
+    Files modified within `min_age` seconds are skipped. Returns (number of
+    files newly linked to the store, bytes saved)."""
+    # pylint: disable=too-many-locals
+    root = osp.abspath(snaps_dir)
+    if not osp.isdir(root):
+        return 0, 0
+    cache = db.get_stat_cache(emdb, root)
+    new_cache = {}
+    nlinked = bytes_saved = 0
+    min_mtime_ns = (time.time() - min_age) * 1e9
+    for entry in os.scandir(root):
+        try:
+            fstat = entry.stat()  # old forks hold symlinks to their origin
+        except FileNotFoundError:
+            continue
+        if (not stat.S_ISREG(fstat.st_mode) or
+                fstat.st_mtime_ns > min_mtime_ns):
+            continue
+        key = (fstat.st_ino, fstat.st_mtime_ns, fstat.st_size)
+        cached = cache.get(entry.name)
+        digest = cached[3] if cached and cached[:3] == key else None
+        if digest is None:
+            digest = _hash_file(entry.path)
+        obj_path = _object_path(store_dir, digest)
+        try:
+            obj_stat = os.stat(obj_path)
+        except FileNotFoundError:
+            obj_stat = None
+        if obj_stat is not None and obj_stat.st_ino == fstat.st_ino:
+            new_cache[entry.name] = key + (digest,)
+            continue  # already in the store
+        try:
+            try:
+                bytes_saved += _link_to_store(entry, fstat, obj_path,
+                                              obj_stat)
+            except FileNotFoundError:
+                if obj_stat is None:
+                    raise
+                # `collect_garbage` removed the object, which nothing
+                # linked to, since it was stat'ed; the file is stored anew
+                bytes_saved += _link_to_store(entry, fstat, obj_path, None)
+        except OSError as err:
+            if err.errno not in ELINK:
+                raise
+            continue  # the store is on another filesystem
+        nlinked += 1
+        fstat = os.stat(entry.path)
+        new_cache[entry.name] = ((fstat.st_ino, fstat.st_mtime_ns,
+                                  fstat.st_size) + (digest,))
+    db.set_stat_cache(emdb, root, new_cache)
+    return nlinked, bytes_saved
+
+
+def link_all(src_dir, dst_dir):
+    """Hardlinks the files of `src_dir` into `dst_dir`.
+
+    Files that cannot be hardlinked are symlinked instead."""
+    os.makedirs(dst_dir, exist_ok=True)
+    for entry in os.scandir(src_dir):
+        dst_path = osp.join(dst_dir, entry.name)
+        try:
+            os.link(osp.realpath(entry.path), dst_path)
+        except OSError as err:
+            if err.errno not in ELINK:
+                raise
+            os.symlink(osp.realpath(entry.path), dst_path)
+
+
+def reflink(src_path, dst_path):
+    """Creates `dst_path` as a reflink of `src_path`.
+
+    Raises OSError, leaving no `dst_path`, if the filesystem cannot."""
+    with open(src_path, 'rb') as f_src, open(dst_path, 'wb') as f_dst:
+        try:
+            fcntl.ioctl(f_dst.fileno(), FICLONE, f_src.fileno())
+        except OSError:
+            f_dst.close()
+            os.remove(dst_path)
+            raise
+
+
+def _copy(src_path, dst_path, full=True):
+    """Copies a file as a reflink if the filesystem supports them, and in
+    full otherwise if `full` is set. Returns whether it was reflinked."""
+    try:
+        reflink(src_path, dst_path)
+        return True
+    except OSError as err:
+        if err.errno not in ELINK:
+            raise
+    if full:
+        shutil.copyfile(src_path, dst_path)
+    return False
+
+
+def _is_overwritable(name):
+    # checkpoints with fixed names (latest.pt, best.pt) are rewritten as a
+    # job goes on; numbered ones are written once
+    return re.search(r'\d', name) is None
+
+
+def unshare(emdb, snaps_dir, mode='auto'):
+    """Replaces the files of `snaps_dir` that are linked to the store or to
+    other experiments by private, writable copies.
+
+    A resumed job may rewrite its checkpoints in place, which would otherwise
+    change every experiment linking to them. With `mode` 'all', every file
+    is copied, which costs as much time and disk as the checkpoints unless
+    the filesystem supports reflinks. With 'auto', files are reflinked where
+    possible; otherwise only the newest checkpoint and those with fixed
+    names, which jobs overwrite, are copied in full and the others stay
+    shared and read-only. With 'none', nothing is copied. Returns the number
+    of copies."""
+    # pylint: disable=too-many-locals
+    root = osp.abspath(snaps_dir)
+    if mode == 'none' or not osp.isdir(root):
+        return 0
+    cache = db.get_stat_cache(emdb, root)
+    new_cache = {}
+    ncopied = 0
+    entries = sorted(os.scandir(root), key=_snap_order)
+    for i, entry in enumerate(entries):
+        try:
+            fstat = entry.stat()
+        except FileNotFoundError:
+            continue
+        if (not stat.S_ISREG(fstat.st_mode) or
+                fstat.st_nlink == 1 and not entry.is_symlink()):
+            continue
+        full = (mode == 'all' or i == len(entries) - 1 or
+                _is_overwritable(entry.name))
+        tmp_path = f'{entry.path}.{os.getpid()}.tmp'
+        if not _copy(entry.path, tmp_path, full) and not full:
+            continue
+        os.chmod(tmp_path, stat.S_IMODE(fstat.st_mode) | stat.S_IWUSR)
+        os.utime(tmp_path, ns=(fstat.st_atime_ns, fstat.st_mtime_ns))
+        os.replace(tmp_path, entry.path)
+        ncopied += 1
+        # the copy need not be hashed again when it is ingested unchanged
+        cached = cache.get(entry.name)
+        key = (fstat.st_ino, fstat.st_mtime_ns, fstat.st_size)
+        if cached and cached[:3] == key:
+            new_cache[entry.name] = ((os.stat(entry.path).st_ino,) +
+                                     cached[1:])
+    db.update_stat_cache(emdb, root, new_cache)
+    return ncopied
+
+
+def _snap_order(entry):
+    # numbers in names (e.g. epochs) are compared numerically; mtimes are
+    # those of the first checkpoint with the same contents once stored
+    return [int(part) if part.isdigit() else part
+            for part in re.split(r'(\d+)', entry.name)]
+
+
+def prune(snaps_dir, keep_last=0, keep_every=0, remove_dir=shutil.rmtree):
+    """Removes all but the last `keep_last` and every `keep_every`-th file
+    (by name) of `snaps_dir`. Returns the names of removed files.
+
+    Checkpoints that are directories are removed with `remove_dir`."""
+    if not osp.isdir(snaps_dir):
+        return []
+    entries = sorted(os.scandir(snaps_dir), key=_snap_order)
+    removed = []
+    for i, entry in enumerate(entries):
+        is_last = keep_last and i >= len(entries) - keep_last
+        is_nth = keep_every and (i + 1) % keep_every == 0
+        if is_last or is_nth:
+            continue
+        if entry.is_dir(follow_symlinks=False):
+            remove_dir(entry.path)
+        else:
+            os.remove(entry.path)
+        removed.append(entry.name)
+    return removed
+
+
+def collect_garbage(store_dir):
+    """Removes stored files that no experiment links to.
+
+    Returns (number of files removed, bytes freed)."""
+    nremoved = bytes_freed = 0
+    if not osp.isdir(store_dir):
+        return 0, 0
+    for prefix in os.scandir(store_dir):
+        if not prefix.is_dir(follow_symlinks=False):
+            continue
+        for entry in os.scandir(prefix.path):
+            fstat = entry.stat(follow_symlinks=False)
+            if fstat.st_nlink == 1:
+                os.remove(entry.path)
+                nremoved += 1
+                bytes_freed += fstat.st_size
+    return nremoved, bytes_freed
@@ -0,0 +1,199 @@
+"""A long-lived process that runs and reaps the background jobs of a project.
+
+The CLI sends launch requests over a Unix socket in the project directory as
+newline-delimited JSON. The supervisor spawns each job as an asyncio
+subprocess and is the only process that records job starts and exits.
+"""
+import asyncio
+import json
+import os
+from os import path as osp
+import socket
+
+from em import capture
+from em import db
+from em import metrics
+from em import resources
+from em import sched
+from em import store
+
+SOCKET_FILE = '.em.sock'
+
+CONNECT_TIMEOUT = 5  # seconds
+
+E_NO_REPLY = 'no reply'
+
+
+def socket_path(proj_dir='.'):
+    """Returns the path of the supervisor socket of a project."""
+    return osp.join(osp.abspath(proj_dir), SOCKET_FILE)
+
+
+def request(msg, proj_dir='.'):
+    """Sends a request to the supervisor and returns its reply.
+
+    Returns None if no supervisor could be reached. A supervisor that fails
+    to reply is reported as a failed request, since it may still have acted
+    on it."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(CONNECT_TIMEOUT)
+    try:
+        sock.connect(socket_path(proj_dir))
+    except OSError:
+        sock.close()
+        return None
+    try:
+        with sock, sock.makefile('rw') as f_sock:
+            f_sock.write(json.dumps(msg) + '\n')
+            f_sock.flush()
+            sock.settimeout(None)
+            reply = f_sock.readline()
+        return json.loads(reply) if reply else {'ok': False,
+                                                'error': E_NO_REPLY}
+    except (OSError, ValueError) as err:
+        return {'ok': False, 'error': str(err) or E_NO_REPLY}
+
+
+def is_running(proj_dir='.'):
+    """Returns whether a supervisor serves the project in `proj_dir`."""
+    return request({'op': 'ping'}, proj_dir) is not None
+
+
+class Supervisor:
+    """Runs jobs on request and records their lifecycle."""
+
+    def __init__(self, proj_dir='.'):
+        self.proj_dir = osp.abspath(proj_dir)
+        self.hostname = socket.getfqdn()
+        self.jobs = {}
+        self.log_stats = {}
+        self.stopping = False
+        self.server = None
+
+    async def _run_job(self, name, cmd, cwd, env, gpu=None, cpus=None,
+                       sample_secs=0, log_stats=()):
+        # pylint: disable=too-many-arguments
+        read_fd, write_fd = os.pipe()
+        job_log = capture.Capture(read_fd, osp.join(cwd, 'run'))
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *cmd, cwd=cwd, env=env, stdin=asyncio.subprocess.DEVNULL,
+                stdout=write_fd, stderr=write_fd,
+                preexec_fn=sched.pin_cpus(cpus), start_new_session=True)
+        finally:
+            os.close(write_fd)
+        with db.connect(self.proj_dir) as emdb:
+            db.job_started(emdb, name, proc.pid, self.hostname, gpu)
+        self.jobs[name] = proc
+        self.log_stats[name] = log_stats
+        asyncio.ensure_future(self._reap(name, proc, cwd, job_log))
+        if sample_secs:
+            sampler = resources.Sampler(proc.pid, osp.join(cwd, 'run'))
+            asyncio.ensure_future(self._sample(sampler, sample_secs))
+        return proc.pid
+
+    @staticmethod
+    async def _sample(sampler, sample_secs):
+        while sampler.sample():
+            await asyncio.sleep(sample_secs)
+
+    async def _reap(self, name, proc, cwd, job_log):
+        # pylint: disable=too-many-arguments
+        returncode = await proc.wait()
+        await asyncio.get_event_loop().run_in_executor(None, job_log.join)
+        with db.connect(self.proj_dir) as emdb:
+            db.job_ended(emdb, name, db.exit_status(returncode), returncode)
+        await asyncio.get_event_loop().run_in_executor(
+            None, self._ingest_snaps, osp.join(cwd, 'run', 'snaps'))
+        await asyncio.get_event_loop().run_in_executor(
+            None, self._update_summaries, [name])
+        del self.jobs[name]
+        del self.log_stats[name]
+        if self.stopping and not self.jobs:
+            self.server.close()
+
+    def _ingest_snaps(self, snaps_dir):
+        with db.connect(self.proj_dir) as emdb:
+            store.ingest(emdb, store.store_path(self.proj_dir), snaps_dir,
+                         min_age=0)
+
+    def _update_summaries(self, names):
+        with db.connect(self.proj_dir) as emdb:
+            for name in names:
+                metrics.update_summaries(
+                    emdb, name,
+                    osp.join(self.proj_dir, 'experiments', name, 'run'),
+                    self.log_stats.get(name, ()))
+
+    async def _beat(self):
+        while True:
+            await asyncio.sleep(sched.HEARTBEAT_SECS)
+            if self.jobs:
+                for name, proc in self.jobs.items():
+                    sched.beat(osp.join(self.proj_dir, 'experiments', name,
+                                        'run'), proc.pid)
+                await asyncio.get_event_loop().run_in_executor(
+                    None, self._update_summaries, list(self.jobs))
+
+    async def _handle(self, msg):
+        if msg.get('op') == 'ping':
+            return {'ok': True, 'jobs': sorted(self.jobs)}
+        if msg.get('op') == 'launch':
+            if self.stopping:
+                return {'ok': False, 'error': 'supervisor is stopping'}
+            if msg['name'] in self.jobs:
+                return {'ok': False, 'error': 'already running'}
+            pid = await self._run_job(msg['name'], msg['cmd'], msg['cwd'],
+                                      msg['env'], msg.get('gpu'),
+                                      msg.get('cpus'),
+                                      msg.get('sample_secs'),
+                                      msg.get('log_stats', ()))
+            return {'ok': True, 'pid': pid}
+        if msg.get('op') == 'stop':
+            self.stopping = True
+            if not self.jobs:
+                self.server.close()
+            return {'ok': True, 'jobs': sorted(self.jobs)}
+        return {'ok': False, 'error': 'unknown request'}
+
+    async def _serve_client(self, reader, writer):
+        try:
+            line = await reader.readline()
+            if line:
+                try:
+                    reply = await self._handle(json.loads(line))
+                except Exception as err:  # pylint: disable=broad-except
+                    # a client without a reply would assume there is no
+                    # supervisor and run the job itself
+                    reply = {'ok': False, 'error': str(err) or repr(err)}
+                writer.write((json.dumps(reply) + '\n').encode())
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self):
+        """Serves requests until stopped and all jobs have exited."""
+        sock_path = socket_path(self.proj_dir)
+        if osp.exists(sock_path):
+            if is_running(self.proj_dir):
+                raise RuntimeError('a supervisor is already running')
+            os.remove(sock_path)
+        self.server = await asyncio.start_unix_server(self._serve_client,
+                                                      path=sock_path)
+        beat = asyncio.ensure_future(self._beat())
+        try:
+            await self.server.wait_closed()
+        finally:
+            beat.cancel()
+            if osp.exists(sock_path):
+                os.remove(sock_path)
+
+
+def serve(proj_dir='.'):
+    """Runs a supervisor for the project in `proj_dir`."""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(Supervisor(proj_dir).serve())
+    finally:
+        loop.close()
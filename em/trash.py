@@ -0,0 +1,115 @@
+"""A trash area from which removed experiment files are deleted lazily.
+
+Removing an experiment renames its directory into the project's trash, which
+takes constant time however large its checkpoints are. A detached reaper
+process then deletes the trash in parallel and collects the garbage of the
+checkpoint store, whose files trashed experiments may have been the last to
+link to.
+"""
+import concurrent.futures
+import errno
+import fcntl
+import os
+from os import path as osp
+import shutil
+import sys
+import time
+
+from em import store
+from em import util
+
+TRASH_DIR = '.em-trash'
+LOCK_FILE = '.lock'
+
+REAPER_WORKERS = 8
+
+W_NOT_REMOVED = 'warning: could not remove "{}" from the trash: {}'
+
+
+def trash_path(proj_dir='.'):
+    """Returns the path of the trash of a project."""
+    return osp.join(osp.abspath(proj_dir), TRASH_DIR)
+
+
+def move(path, trash_dir):
+    """Moves a file or directory into the trash.
+
+    Deletes it right away if it is on another filesystem than the trash.
+    Returns whether there was anything to move, and so to reap."""
+    if not osp.lexists(path):
+        return False
+    os.makedirs(trash_dir, exist_ok=True)
+    dst_path = osp.join(trash_dir,
+                        f'{osp.basename(path)}.{time.time_ns():d}')
+    try:
+        os.rename(path, dst_path)
+    except OSError as err:
+        if err.errno != errno.EXDEV:
+            raise
+        _remove(path)
+    return True
+
+
+def _warn_not_removed(_func, path, exc_info):
+    print(W_NOT_REMOVED.format(path, exc_info[1]), file=sys.stderr)
+
+
+def _remove(path):
+    try:
+        if osp.isdir(path) and not osp.islink(path):
+            shutil.rmtree(path, onerror=_warn_not_removed)
+        else:
+            os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError as err:
+        _warn_not_removed(None, path, (type(err), err, None))
+
+
+def _trashed(trash_dir):
+    return [entry for entry in os.scandir(trash_dir)
+            if entry.name != LOCK_FILE]
+
+
+def empty(trash_dir, workers=REAPER_WORKERS):
+    """Deletes the contents of the trash.
+
+    Returns the names of the entries that were in the trash. Entries that
+    cannot be removed are left in place."""
+    entries = _trashed(trash_dir)
+    # the children of each entry are deleted in parallel so that a single
+    # experiment with many checkpoints is not deleted by one thread
+    children = []
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            children.extend(child.path for child in os.scandir(entry.path))
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        list(pool.map(_remove, children))
+        list(pool.map(_remove, [entry.path for entry in entries]))
+    return {entry.name for entry in entries}
+
+
+def reap(proj_dir='.'):
+    """Empties the trash of a project and collects store garbage.
+
+    Returns right away if another reaper is already running."""
+    trash_dir = trash_path(proj_dir)
+    os.makedirs(trash_dir, exist_ok=True)
+    with open(osp.join(trash_dir, LOCK_FILE), 'w') as f_lock:
+        try:
+            fcntl.flock(f_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return  # the running reaper also deletes what was just trashed
+        # entries trashed while emptying are picked up by the next pass;
+        # stop once a pass removes nothing, as what is left cannot be removed
+        while True:
+            trashed = empty(trash_dir)
+            left = {entry.name for entry in _trashed(trash_dir)}
+            if not left or left == trashed:
+                break
+        store.collect_garbage(store.store_path(proj_dir))
+
+
+def spawn_reaper(proj_dir='.'):
+    """Runs `reap` in a detached background process."""
+    util.spawn_daemon(reap, osp.abspath(proj_dir))
@@ -0,0 +1,10 @@
+"""Formatting of quantities for humans."""
+
+
+def fmt_bytes(nbytes):
+    """Returns a number of bytes in binary units, e.g. `1.5 MiB`."""
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if nbytes < 1024 or unit == 'GiB':
+            break
+        nbytes /= 1024
+    return f'{nbytes:.1f} {unit}' if unit != 'B' else f'{nbytes:.0f} B'
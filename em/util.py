@@ -0,0 +1,60 @@
+"""Helpers shared by the em commands."""
+import datetime
+import os
+from os import path as osp
+import sys
+
+E_NO_BRANCH = 'error: no branch for experiment "{}"?'
+E_NO_EXP = 'error: no experiment named "{}"'
+
+
+def die(msg, status=1):
+    """Prints an error message. Returns the exit status of a command."""
+    print(msg, file=sys.stderr)
+    return status
+
+
+def expath(*args):
+    """Returns the absolute path of a file of an experiment."""
+    return osp.abspath(osp.join('experiments', *args))
+
+
+def tstamp():
+    """Returns the current local time."""
+    import time
+    return datetime.datetime.fromtimestamp(time.time())
+
+
+def get_branch(repo, branch_name):
+    """Returns the branch named `branch_name`, or None."""
+    import pygit2
+    br = None
+    try:
+        br = repo.lookup_branch(branch_name)
+    except pygit2.GitError:
+        pass
+    return br
+
+
+def print_table(rows):
+    """Prints rows of strings as aligned columns."""
+    widths = [max(map(len, col)) for col in zip(*rows)]
+    for row in rows:
+        print('  '.join(cell.ljust(width)
+                        for cell, width in zip(row, widths)).rstrip())
+
+
+def spawn_daemon(func, *args, **kwargs):
+    """Runs `func(*args, **kwargs)` in a detached daemon process, without
+    detaching this one."""
+    import daemon
+    curdir = osp.abspath(os.curdir)
+    pid = os.fork()
+    if pid == 0:
+        try:
+            with daemon.DaemonContext(working_directory=curdir,
+                                      detach_process=True):
+                func(*args, **kwargs)
+        finally:
+            os._exit(0)  # pylint: disable=protected-access
+    os.waitpid(pid, 0)  # the daemon has detached from the child